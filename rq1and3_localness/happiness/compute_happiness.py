@@ -1,5 +1,6 @@
 """RQ3: Happiness algorithm as impacted by localness"""
 
+import array
 import csv
 import os
 import argparse
@@ -13,6 +14,7 @@ from scipy.stats import wilcoxon
 
 sys.path.append("./utils")
 import bots
+from tweet_columns import iter_rows
 
 LOCALNESS_METRICS = ['nday','plurality']
 HAPPINESS_EVALUATIONS_FN = "../resources/happiness_evaluations.txt"
@@ -36,16 +38,103 @@ def build_happiness_dict():
     return happy_dict
 
 
-def compute_happiness(scale='counties'):
-    """Compute happiness by county based on localness-processed CSV from localness.py."""
+def new_region_stats():
+    """Happiness of local and nonlocal tweets in a region plus counts of tweets without happy words or from bots."""
+    return {'local': array.array('d'), 'nonlocal': array.array('d'), 'local_no_happy': 0, 'nonlocal_no_happy': 0,
+            'local_bots': 0, 'nonlocal_bots': 0}
+
+
+def tweet_happiness(txt, happy_dict):
+    """Average happiness of the words in txt found in happy_dict, or None if there are none."""
+    total_happ = 0.0
+    count_words = 0
+    for word in txt.split():
+        cleaned = word.lower().strip('?!.,;:()[]{}"\'')
+        if cleaned in happy_dict:
+            count_words += 1
+            total_happ += happy_dict[cleaned]
+    if count_words > 0:
+        return total_happ / count_words
+    return None
+
+
+def add_tweet(stats, uid, local, h_avg_txt, bots_filter):
+    prefix = 'local' if local else 'nonlocal'
+    if uid in bots_filter:
+        stats[prefix + '_bots'] += 1
+    elif h_avg_txt is not None:
+        stats[prefix].append(h_avg_txt)
+    else:
+        stats[prefix + '_no_happy'] += 1
+
+
+def happiness_row(fips, stats):
+    local_tweets = stats['local']
+    non_local = stats['nonlocal']
+    return [fips, numpy.median(local_tweets), numpy.average(local_tweets), numpy.median(non_local),
+            numpy.average(non_local), numpy.median(local_tweets + non_local), numpy.average(local_tweets + non_local),
+            len(local_tweets), len(non_local), stats['local_no_happy'], stats['nonlocal_no_happy']]
+
+
+def region_stats_from_files(tweets_dir, tweets_fns, localness, happy_dict, bots_filter):
+    """Yield (fips, region stats) for a localness metric from the per-region files of filter_tweets_by_region.py."""
+    for file in tweets_fns:
+        with open(os.path.join(tweets_dir, file), 'r') as fin:
+            fips = os.path.splitext(file)[0]  # files named by <FIPS-CODE>.csv
+            csvreader = csv.reader(fin)
+            header = ['text','uid','nday','plurality']
+            txt_idx = header.index('text')
+            uid_idx = header.index('uid')
+            localness_idx = header.index(localness)
+            assert next(csvreader) == header
+            stats = new_region_stats()
+            for line in csvreader:
+                txt = line[txt_idx]
+                uid = line[uid_idx]
+                if not line[localness_idx]:
+                    continue
+                local = (line[localness_idx] == 'True')
+                add_tweet(stats, uid, local, tweet_happiness(txt, happy_dict), bots_filter)
+        yield fips, stats
+
+
+def region_stats_from_columns(columns_dir, happy_dict, bots_filter):
+    """One pass over a localness.py INPUT_COLUMNS_DIR store: {localness metric: {fips: region stats}}.
+
+    Reads only the county, text, uid, and localness columns, and scores each tweet's text once for all metrics.
+    """
+    region_stats = {localness: {} for localness in LOCALNESS_METRICS}
+    columns = ['processed', 'county', 'text', 'uid'] + LOCALNESS_METRICS
+    for row in iter_rows(columns_dir, columns):
+        processed, fips, txt, uid = row[:4]
+        if not processed or not fips or txt is None:  # no text (e.g., only full_text): not in the CSV path's files
+            continue
+        uid = str(uid)
+        h_avg_txt = tweet_happiness(txt, happy_dict) if uid not in bots_filter else None
+        for localness, local in zip(LOCALNESS_METRICS, row[4:]):
+            if fips not in region_stats[localness]:
+                region_stats[localness][fips] = new_region_stats()
+            add_tweet(region_stats[localness][fips], uid, local, h_avg_txt, bots_filter)
+    return region_stats
+
+
+def compute_happiness(scale='counties', columns_dir=None):
+    """Compute happiness by county based on localness-processed CSV from localness.py.
+
+    The tweets are read from the per-region files written by filter_tweets_by_region.py or, with columns_dir, straight
+    from the localness.py columnar store.
+    """
 
     # generate word -> happiness dictionary
     happy_dict = build_happiness_dict()
     bots_filter = bots.build_bots_filter()
 
     # directory containing all of the tweets sorted by state or county depending on scale - one file for each region
-    tweets_dir = './{0}'.format(scale)
-    tweets_fns = os.listdir(tweets_dir)
+    if columns_dir:
+        region_stats = region_stats_from_columns(columns_dir, happy_dict, bots_filter)
+    else:
+        tweets_dir = './{0}'.format(scale)
+        tweets_fns = os.listdir(tweets_dir)
 
     output_fn = "./raw_happiness_results_{0}.csv".format(scale)
     with open(output_fn, "w") as fout:
@@ -56,58 +145,14 @@ def compute_happiness(scale='counties'):
                                 'total_local', 'total_nonlocal', 'local_excluded', 'nonlocal_excluded'])
             local_filtered_out = 0
             nonlocal_filtered_out = 0
-            for file in tweets_fns:
-                with open(os.path.join(tweets_dir, file), 'r') as fin:
-                    fips = os.path.splitext(file)[0]  # files named by <FIPS-CODE>.csv
-                    csvreader = csv.reader(fin)
-                    header = ['text','uid','nday','plurality']
-                    txt_idx = header.index('text')
-                    uid_idx = header.index('uid')
-                    localness_idx = header.index(localness)
-                    assert next(csvreader) == header
-                    local_tweets = []
-                    lt_no_happy_words = 0
-                    non_local = []
-                    nl_no_happy_words = 0
-                    for line in csvreader:
-                        txt = line[txt_idx]
-                        uid = line[uid_idx]
-                        if not line[localness_idx]:
-                            continue
-                        local = (line[localness_idx] == 'True')
-                        if uid in bots_filter:
-                            if local:
-                                local_filtered_out += 1
-                            else:
-                                nonlocal_filtered_out += 1
-                            continue
-                        total_happ = 0.0
-                        count_words = 0
-                        for word in txt.split():
-                            cleaned = word.lower().strip('?!.,;:()[]{}"\'')
-                            if cleaned in happy_dict:
-                                count_words += 1
-                                total_happ += happy_dict[cleaned]
-                        if count_words > 0:
-                            h_avg_txt = total_happ / count_words
-                            if local:
-                                local_tweets.append(h_avg_txt)
-                            else:
-                                non_local.append(h_avg_txt)
-                        else:
-                            if local:
-                                lt_no_happy_words += 1
-                            else:
-                                nl_no_happy_words += 1
-
-                    local_med_h = numpy.median(local_tweets)
-                    local_avg_h = numpy.average(local_tweets)
-                    nonlocal_med_h = numpy.median(non_local)
-                    nonlocal_avg_h =  numpy.average(non_local)
-                    unfiltered_med_h = numpy.median(local_tweets + non_local)
-                    unfiltered_avg_h = numpy.average(local_tweets + non_local)
-                    csvwriter.writerow([fips, local_med_h, local_avg_h, nonlocal_med_h, nonlocal_avg_h, unfiltered_med_h,
-                                        unfiltered_avg_h, len(local_tweets), len(non_local), lt_no_happy_words, nl_no_happy_words])
+            if columns_dir:
+                regions = sorted(region_stats[localness].items())
+            else:
+                regions = region_stats_from_files(tweets_dir, tweets_fns, localness, happy_dict, bots_filter)
+            for fips, stats in regions:
+                csvwriter.writerow(happiness_row(fips, stats))
+                local_filtered_out += stats['local_bots']
+                nonlocal_filtered_out += stats['nonlocal_bots']
             print("{0} 'local' tweets and {1} 'nonlocal' tweets filtered out from organizations for {2}.".format(local_filtered_out, nonlocal_filtered_out, localness))
 
     process_happiness_results(scale, output_fn)
@@ -243,8 +288,9 @@ def process_happiness_results(scale, input_fn):
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--scale", default = "counties", help = "compute happiness by either 'states' or 'counties'")
+    parser.add_argument("--columns_dir", default = None, help = "localness.py INPUT_COLUMNS_DIR store to read instead of the per-region files")
     args = parser.parse_args()
-    compute_happiness(scale = args.scale)
+    compute_happiness(scale = args.scale, columns_dir = args.columns_dir)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
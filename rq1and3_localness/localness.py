@@ -1,16 +1,37 @@
+import argparse
 import csv
+import glob
 import traceback
 import json
+import multiprocessing
+import os
+import pickle
+import shutil
 import sys
+import time
 
-import psycopg2
-import psycopg2.extras
-from shapely.wkt import loads
-from shapely.geometry import shape
-from shapely.geometry import box
+import numpy
 
 sys.path.append("./utils")
 import demographic_labeling
+from county_index import load_county_index
+from county_grid import load_county_grid
+from point_cache import PointCache
+from nday_table import read_nday_table
+from nday_db import connect
+from nday_db import stream_nday_rows
+from nday_db import stream_user_summaries
+from user_regions import UserRegions
+from tweet_fields import TweetParser
+from tweet_fields import LOCALNESS_FIELDS
+from tweet_fields import get_loads
+from tweet_columns import chunk_fn
+from tweet_columns import list_chunks
+from tweet_columns import read_chunk
+from tweet_columns import write_chunk
+from progress_log import ProgressLog
+from progress_log import peak_rss_mb
+from progress_log import StageTimer
 
 COUNT_GEOTAGGED = 0
 
@@ -18,8 +39,12 @@ COUNT_GEOTAGGED = 0
 SCALE = "counties"
 FIPS_LENGTH = 5
 
+DB_BACKEND = "postgres"  # or "sqlite" with DB_NAME as the database file
 DB_NAME = "<PSQL DB NAME>"
 NDAY_TABLE_NAME = "<PSQL TABLE NAME>"
+NDAY_FN = None  # (uid, fips, count, ntime) file from utils/nday_table.py - read instead of NDAY_TABLE_NAME when set
+NDAY_ITERSIZE = 100000  # rows per round trip from the server-side cursor over NDAY_TABLE_NAME
+NDAY_PUSHDOWN = False  # compute plurality and n-day flags in SQL so only one row per user is transferred
 NDAY_MIN = 10  # minimum span of days between first and last VGI for a county to be counted as local
 
 GEOMED_RESULTS_FN = "<FILE PATH TO GEOMED RESULTS CSV>"
@@ -34,55 +59,119 @@ INPUT_COLUMNS = ['tweet']
 EXTEND_COLUMNS = ['gender', 'race', 'county', 'nday', 'plurality', 'geomed', 'locfield']
 OUTPUT_COLUMNS = INPUT_COLUMNS + EXTEND_COLUMNS
 OUTPUT_FN = "<FILE PATH TO OUTPUT VGI DATA WITH LOCALNESS INFO APPENDED CSV>"
+# store from utils/tweet_columns.py - read instead of INPUT_FN when set, with the EXTEND_COLUMNS written into the store
+#  as localness_NNNNN.npz alongside each tweets_NNNNN.npz instead of to OUTPUT_FN
+INPUT_COLUMNS_DIR = None
 
 COMPUTE_COUNTY_FROM_LAT_LON = True
+USE_COUNTY_GRID = True  # precomputed grid so only tweets near county boundaries need an exact polygon test
+POINT_CACHE_DECIMALS = 6  # lat/lon rounded to this many decimals for the point -> county cache
+POINT_CACHE_SIZE = 2000000  # maximum points held in the cache before least recently used are evicted
+POINT_CACHE_FN = None  # optional CSV path so the cache persists between runs
 COMPUTE_DEMOGRAPHICS = True
 
-def get_county(counties, pt):
+NUM_WORKERS = 1  # > 1 annotates byte-range chunks of INPUT_FN in this many processes
+CHUNKS_PER_WORKER = 4  # more, smaller chunks even out workers that get slow chunks
+JSON_BACKEND = 'auto'  # tweet JSON parser: 'orjson', 'ujson', 'json', or 'auto' for the fastest one installed
+MERGE_SHARDS = True  # concatenate the per-chunk outputs into OUTPUT_FN (otherwise leave OUTPUT_FN.partN files)
+LOOKUPS = {}  # read-only lookup structures built by main(); forked workers share them
+
+# With --resume, a run picks up from its last checkpoint and reloads LOOKUPS from the cache instead of the database and
+#  census. Serial runs over INPUT_FN checkpoint input/output byte offsets; chunked runs skip finished chunks.
+CHECKPOINT_EVERY = 500000  # lines between checkpoints (0 turns them and the lookup cache off)
+CACHE_LOOKUPS = True  # pickle LOOKUPS (minus the county index) next to the checkpoint for --resume
+RESUME = False  # set by --resume
+PROGRESS_EVERY = 100000  # lines between progress messages
+PROGRESS_LOG = True  # also append JSON-lines records (rows/sec, ETA, peak RSS, stage times) to *.progress.jsonl
+
+def get_county(county_index, lat, lon):
     global COUNT_GEOTAGGED
-    for state in counties:
-        if counties[state]['bb'].contains(pt):
-            for fips in counties[state]['counties']:
-                if counties[state]['counties'][fips].contains(pt):
-                    COUNT_GEOTAGGED += 1
-                    return fips
-    return None
+    fips = county_index.lookup(lat, lon)
+    if fips:
+        COUNT_GEOTAGGED += 1
+    return fips
 
 def print_progress(line_number, count_failed, count_processed, count_gender, count_race, loc_failed):
-    print("{0} lines read in, {1} processed fully, {2} location field lookups failed, and {3} failed for other reasons."
-          "and {3} total written out to {4}.".format(line_number, count_processed, loc_failed, count_failed))
+    print("{0} lines read in, {1} processed fully, {2} location field lookups failed, and {3} failed for other "
+          "reasons.".format(line_number, count_processed, loc_failed, count_failed))
     print("{0} gender determined and {1} race determined.".format(count_gender, count_race))
     print("{0} located in the US.".format(COUNT_GEOTAGGED))
 
 def main():
+    global RESUME
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue an interrupted run from its last checkpoint with its cached lookups")
+    args = parser.parse_args()
+    RESUME = args.resume
+
+    lookups_fn = checkpoint_base() + '.lookups.pickle'
+    lookups = load_cached_lookups(lookups_fn) if RESUME and checkpoint_exists() else None
+    if lookups is None:
+        lookups = build_lookups()
+        if CACHE_LOOKUPS and CHECKPOINT_EVERY:
+            cached = {'config': lookups_config(), 'lookups': lookups}
+            pickle_atomic(lookups_fn, cached)
 
-    conn = psycopg2.connect("dbname={0}".format(DB_NAME))
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    psycopg2.extensions.register_adapter(dict, psycopg2.extras.Json)
+    if COMPUTE_COUNTY_FROM_LAT_LON:
+        county_index = load_county_index()
+        if USE_COUNTY_GRID:
+            county_index = load_county_grid(county_index)
+        county_index = PointCache(county_index, POINT_CACHE_DECIMALS, POINT_CACHE_SIZE, POINT_CACHE_FN)
+        print("{0} counties indexed.".format(len(county_index)))
+        lookups['county_index'] = county_index
+    LOOKUPS.update(lookups)
 
-    print("Querying database for nday/plurality results...")
-    # SQL: CREATE TABLE <TABLENAME> (uid bigint, fips char(5), count int, ntime interval);
-    cur.execute("SELECT uid, fips, count, ntime FROM {0};".format(NDAY_TABLE_NAME))
+    print("Parsing tweet JSON with {0}.".format(get_loads(JSON_BACKEND)[0]))
+    if INPUT_COLUMNS_DIR:
+        assert COMPUTE_COUNTY_FROM_LAT_LON, "The columnar store has coordinates but no precomputed county column."
+    print("Now to process localness!")
+    if NUM_WORKERS > 1:
+        counts = parallel_annotate()
+    elif INPUT_COLUMNS_DIR:
+        chunks = list_chunks(INPUT_COLUMNS_DIR)
+        counts = merge_counts((annotate_column_chunk(chunk_idx) for chunk_idx in chunks), len(chunks))
+        remove_chunk_counts([column_counts_fn(chunk_idx) for chunk_idx in chunks])
+    else:
+        counts = annotate_file()
+        if os.path.exists(checkpoint_base() + '.checkpoint'):
+            os.remove(checkpoint_base() + '.checkpoint')
+    if os.path.exists(lookups_fn):  # only needed to resume this run
+        os.remove(lookups_fn)
+    print_progress(counts['line_number'], counts['failed'], counts['processed'], counts['gender'], counts['race'],
+                   counts['loc_failed'])
+    print("Time by stage: {0}.".format(StageTimer(counts['stages']).summary()))
+    if COMPUTE_COUNTY_FROM_LAT_LON:
+        LOOKUPS['county_index'].print_stats()
+        if NUM_WORKERS <= 1:
+            LOOKUPS['county_index'].save()  # each worker's cache is its own, so only saved from a serial run
+    if INPUT_COLUMNS_DIR:
+        print("VGI read in from and localness output to {0}.".format(INPUT_COLUMNS_DIR))
+    else:
+        print("VGI read in from {0} and output to {1}.".format(INPUT_FN, OUTPUT_FN))
+
+
+def build_lookups():
+    """Build the n-day/plurality/geomedian, location field, and census lookups from the original sources."""
+
+    user_regions = UserRegions(NDAY_MIN, FIPS_LENGTH)
+    if NDAY_FN:
+        print("Reading nday/plurality results from {0}...".format(NDAY_FN))
+        user_regions.add_rows(read_nday_table(NDAY_FN))
+    elif NDAY_PUSHDOWN:
+        print("Querying database for per-user nday/plurality summaries...")
+        conn = connect(DB_BACKEND, DB_NAME)
+        user_regions.add_summaries(stream_user_summaries(conn, NDAY_TABLE_NAME, NDAY_MIN, NDAY_ITERSIZE))
+    else:
+        conn = connect(DB_BACKEND, DB_NAME)
+
+        print("Querying database for nday/plurality results...")
+        # SQL: CREATE TABLE <TABLENAME> (uid bigint, fips char(5), count int, ntime interval);
+        user_regions.add_rows(stream_nday_rows(conn, NDAY_TABLE_NAME, NDAY_ITERSIZE))
 
     print("Processing nday and plurality...")
-    user_regions = {}
-    for row in cur:
-        uid = str(row[0])  # bigint -> string
-        region = row[1]
-        if region:
-            region = region[:FIPS_LENGTH]  # string
-        count_VGI = row[2]  # int
-        ntime = row[3]  # PostgreSQL interval converted to datetime.timedelta by psycopg2
-        if uid in user_regions:
-            user_regions[uid][region] = (ntime.days >= NDAY_MIN)
-            if count_VGI > user_regions[uid]['plurality_count']:
-                user_regions[uid]['plurality'] = [region]
-                user_regions[uid]['plurality_count'] = count_VGI
-            elif count_VGI == user_regions[uid]['plurality_count']:
-                user_regions[uid]['plurality'].append(region)
-        else:
-            user_regions[uid] = {region : ntime.days >= NDAY_MIN, 'plurality' : [region], 'plurality_count': count_VGI}
-    print("{0} users processed.".format(len(user_regions)))
+    user_regions.finalize()
+    print("{0} users processed ({1:.1f} MB).".format(len(user_regions), user_regions.nbytes() / 1048576.0))
 
     print("Processing VGI geometric median results...")
     with open(GEOMED_RESULTS_FN, 'r') as fin:
@@ -95,9 +184,9 @@ def main():
             try:
                 if region:
                     count_vgimed += 1
-                    user_regions[uid]['median'] = region
+                    user_regions.set_median(uid, region)
                 elif uid in user_regions:
-                    user_regions[uid]['median'] = False
+                    user_regions.set_median(uid, None)
             except KeyError as e:
                 print(e, line)
                 continue
@@ -117,123 +206,458 @@ def main():
             locations[loc_field] = region
     print("{0} locations registered.".format(len(locations)))
 
-    print("Now to process localness!")
-    line_number = 0
-    count_processed = 0
-    count_failed = 0
-    loc_failed = 0
-    count_gender = 0
-    count_race = 0
-
+    lookups = {'user_regions': user_regions, 'locations': locations}
     if COMPUTE_DEMOGRAPHICS:
-        gender_idx = OUTPUT_COLUMNS.index('gender')
-        race_idx = OUTPUT_COLUMNS.index('race')
-        males, females = demographic_labeling.get_census_names()
-        surnames_to_race = demographic_labeling.get_census_race()
+        lookups['males'], lookups['females'] = demographic_labeling.get_census_names()
+        lookups['surnames_to_race'] = demographic_labeling.get_census_race()
+    return lookups
 
-    if COMPUTE_COUNTY_FROM_LAT_LON:
-        counties_fn = 'resources/USCounties_bare.geojson'
-        with open(counties_fn, 'r') as fin:
-            counties_gj = json.load(fin)
-
-        states_fn = 'resources/US_States_from_counties.geojson'
-        with open(states_fn, 'r') as fin:
-            states_gj = json.load(fin)
-
-        counties = {}
-        for state in states_gj['features']:
-            west, south, east, north = shape(state['geometry']).bounds
-            counties[state['properties']['FIPS'][:2]] = {'bb':box(west, south, east, north), 'counties':{}}
-        for region in counties_gj['features']:
-            state_fips = region['properties']['FIPS'][:2]
-            counties[state_fips]['counties'][region['properties']['FIPS']] = shape(region['geometry'])
-        del(counties_gj)
-        del(states_gj)
-
-    with open(OUTPUT_FN, 'w') as fout:
+
+def new_counts():
+    """Counters for a run plus its StageTimer timings under 'stages'."""
+    return {'line_number': 0, 'processed': 0, 'failed': 0, 'loc_failed': 0, 'gender': 0, 'race': 0, 'stages': {}}
+
+
+def merge_counts(chunk_counts, num_chunks):
+    """Sum the counts of each chunk as it finishes and add their geotagged tweets to COUNT_GEOTAGGED.
+
+    A 'total' record for the whole run is logged after each chunk, with the share of the num_chunks done for the ETA.
+    """
+    global COUNT_GEOTAGGED
+    counts = new_counts()
+    timer = StageTimer(counts['stages'])
+    done = 0
+    log = ProgressLog(progress_log_fn(), 'total', lambda: done / float(num_chunks or 1))
+    for c in chunk_counts:
+        for key in counts:
+            if key not in ('stages', 'peak_rss_mb'):
+                counts[key] += c[key]
+        timer.merge(c.get('stages', {}))
+        COUNT_GEOTAGGED += c['geotagged']
+        if c.get('peak_rss_mb') is not None:  # live workers aren't in this process's RUSAGE_CHILDREN
+            counts['peak_rss_mb'] = max(counts.get('peak_rss_mb', 0.0), c['peak_rss_mb'])
+        done += 1
+        if done < num_chunks:
+            log.write(counts)
+    log.write(counts, final=True)
+    return counts
+
+
+def checkpoint_base():
+    """Path prefix for this run's checkpoint, lookup cache, and progress log files."""
+    return os.path.join(INPUT_COLUMNS_DIR, 'localness') if INPUT_COLUMNS_DIR else OUTPUT_FN
+
+
+def progress_log_fn():
+    return checkpoint_base() + '.progress.jsonl' if PROGRESS_LOG else None
+
+
+def lookups_config():
+    """Settings that build_lookups() depends on, stored with the cached lookups so a changed config rebuilds them."""
+    return {'SCALE': SCALE, 'FIPS_LENGTH': FIPS_LENGTH, 'DB_BACKEND': DB_BACKEND, 'DB_NAME': DB_NAME,
+            'NDAY_TABLE_NAME': NDAY_TABLE_NAME, 'NDAY_FN': NDAY_FN, 'NDAY_PUSHDOWN': NDAY_PUSHDOWN,
+            'NDAY_MIN': NDAY_MIN, 'GEOMED_RESULTS_FN': GEOMED_RESULTS_FN, 'LOCFIELD_RESULTS_FN': LOCFIELD_RESULTS_FN,
+            'COMPUTE_DEMOGRAPHICS': COMPUTE_DEMOGRAPHICS}
+
+
+def load_cached_lookups(lookups_fn):
+    """Lookups cached by the interrupted run, or None if there are none or they were built with other settings."""
+    if not os.path.exists(lookups_fn):
+        return None
+    with open(lookups_fn, 'rb') as fin:
+        cached = pickle.load(fin)
+    if not isinstance(cached, dict) or cached.get('config') != lookups_config():
+        print("Not using {0}: it was built with different settings.".format(lookups_fn))
+        return None
+    print("Loaded lookups cached from the interrupted run at {0}.".format(lookups_fn))
+    return cached['lookups']
+
+
+def checkpoint_exists():
+    """Whether an interrupted run left a checkpoint (or finished chunks) to resume from."""
+    if INPUT_COLUMNS_DIR:
+        return any(os.path.exists(column_counts_fn(chunk_idx)) for chunk_idx in list_chunks(INPUT_COLUMNS_DIR))
+    if NUM_WORKERS > 1:
+        return bool(glob.glob(glob.escape(OUTPUT_FN) + '.part*.counts'))
+    return os.path.exists(checkpoint_base() + '.checkpoint')
+
+
+def write_atomic(fn, data):
+    """Write bytes to fn so that a crash leaves the old file or the new one, never part of one."""
+    with open(fn + '.tmp', 'wb') as fout:
+        fout.write(data)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(fn + '.tmp', fn)
+
+
+def pickle_atomic(fn, obj):
+    """Pickle obj to fn as write_atomic does, streaming it to the file rather than building the bytes in memory."""
+    with open(fn + '.tmp', 'wb') as fout:
+        pickle.dump(obj, fout, pickle.HIGHEST_PROTOCOL)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(fn + '.tmp', fn)
+
+
+def save_checkpoint(input_offset, fout, counts):
+    """Record that everything before input_offset in INPUT_FN is in fout, once fout is safely on disk."""
+    fout.flush()
+    os.fsync(fout.fileno())
+    checkpoint = {'input_fn': INPUT_FN, 'output_fn': OUTPUT_FN, 'input_offset': input_offset,
+                  'output_offset': fout.tell(), 'counts': counts, 'geotagged': COUNT_GEOTAGGED}
+    write_atomic(checkpoint_base() + '.checkpoint', json.dumps(checkpoint).encode('utf-8'))
+
+
+def load_checkpoint():
+    """Return the last checkpoint written by save_checkpoint, or None if there isn't one."""
+    checkpoint_fn = checkpoint_base() + '.checkpoint'
+    if not os.path.exists(checkpoint_fn):
+        return None
+    with open(checkpoint_fn, 'r') as fin:
+        checkpoint = json.load(fin)
+    assert checkpoint['input_fn'] == INPUT_FN and checkpoint['output_fn'] == OUTPUT_FN, \
+        "{0} is for a run over {1}".format(checkpoint_fn, checkpoint['input_fn'])
+    return checkpoint
+
+
+def load_chunk_counts(counts_fn, task):
+    """Counts of a chunk that an interrupted run finished, or None if the chunk has to be (re)done."""
+    if not RESUME or not os.path.exists(counts_fn):
+        return None
+    with open(counts_fn, 'r') as fin:
+        saved = json.load(fin)
+    return saved['counts'] if saved['task'] == list(task) else None
+
+
+def save_chunk_counts(counts_fn, task, counts):
+    if not CHECKPOINT_EVERY:
+        return
+    write_atomic(counts_fn, json.dumps({'task': list(task), 'counts': counts}).encode('utf-8'))
+
+
+def remove_chunk_counts(counts_fns):
+    for counts_fn in counts_fns:
+        if os.path.exists(counts_fn):
+            os.remove(counts_fn)
+
+
+class OffsetLines(object):
+    """Iterate the decoded lines of a file from a byte offset up to end (or the end of the file).
+
+    offset is always the start of the first line not yet read.
+    """
+
+    def __init__(self, fn, offset=0, end=None):
+        self.fn = fn
+        self.offset = offset
+        self.end = os.path.getsize(fn) if end is None else end
+
+    def __iter__(self):
+        with open(self.fn, 'rb') as fin:
+            fin.seek(self.offset)
+            for line in fin:
+                if self.offset >= self.end:
+                    break
+                self.offset += len(line)
+                yield line.decode('utf-8')
+
+
+def annotate_file():
+    """Annotate INPUT_FN into OUTPUT_FN in this process, checkpointing every CHECKPOINT_EVERY lines.
+
+    With --resume, OUTPUT_FN is cut back to the last checkpoint and INPUT_FN is read from the matching offset. Like the
+    parallel mode this assumes one record per line.
+    """
+    global COUNT_GEOTAGGED
+    counts = new_counts()
+    checkpoint = load_checkpoint() if RESUME else None
+    if checkpoint:
+        print("Resuming after line {0} from {1}.".format(checkpoint['counts']['line_number'],
+                                                         checkpoint_base() + '.checkpoint'))
+        counts.update(checkpoint['counts'])
+        COUNT_GEOTAGGED = checkpoint['geotagged']
+        with open(OUTPUT_FN, 'r+b') as fout:
+            fout.truncate(checkpoint['output_offset'])
+        lines = OffsetLines(INPUT_FN, checkpoint['input_offset'])
+    else:
+        if RESUME:
+            print("No checkpoint found - starting from the beginning.")
+        lines = OffsetLines(INPUT_FN)
+    log = ProgressLog(progress_log_fn(), 'serial', lambda: lines.offset / float(lines.end or 1), counts['line_number'])
+    with open(OUTPUT_FN, 'a' if checkpoint else 'w') as fout:
         csvwriter = csv.writer(fout)
-        csvwriter.writerow(OUTPUT_COLUMNS)
-        with open(INPUT_FN, 'r') as fin:
-            csvreader = csv.reader(fin)
-            try:
-                tweet_idx = OUTPUT_COLUMNS.index('tweet')
-            except ValueError:
-                tweet_idx = -1
-            # alternatively replace the user_location_idx with the tweet if you have that full object and adjust code
-            #  to pull location field entry from tweet json object
-            county_idx = OUTPUT_COLUMNS.index('county')
-            nday_idx = OUTPUT_COLUMNS.index('nday')
-            plur_idx = OUTPUT_COLUMNS.index('plurality')
-            geomed_idx = OUTPUT_COLUMNS.index('geomed')
-            locfield_idx = OUTPUT_COLUMNS.index('locfield')
-            default_extend_columns = [False for i in range(0, len(EXTEND_COLUMNS))]
+        csvreader = csv.reader(lines)
+        if not checkpoint:
+            csvwriter.writerow(OUTPUT_COLUMNS)
             if INPUT_HAS_HEADER:
                 assert next(csvreader) == INPUT_COLUMNS
-            for record in csvreader:
-                line_number += 1
-                try:
-                    tweet = json.loads(record[tweet_idx])
-                    uid = str(tweet['user']['id'])
-                    record.extend(default_extend_columns)  # NOTE: using extend means that a copy is inserted
-
-                    if COMPUTE_COUNTY_FROM_LAT_LON
-                        if tweet['geo']:  # has coordinates
-                            pt = loads('POINT ({0} {1})'.format(
-                                    tweet['geo']['coordinates'][1], tweet['geo']['coordinates'][0]))
-                            region = get_county(counties, pt)
-                        else:
-                            region = None
-                    else:
-                        region = record[county_idx]
-                    if region:
-                        region = region[:FIPS_LENGTH]
-                    record[county_idx] = region  # output file will reflect state or county scale
-
-                    if COMPUTE_DEMOGRAPHICS:
-                        gender = demographic_labeling.label_gender(tweet, males, females)
-                        if gender != 'n':
-                            count_gender += 1
-                        race = demographic_labeling.label_race_by_last_name(tweet, surnames_to_race)
-                        if race != 'n':
-                            count_race += 1
-                        record[gender_idx] = gender
-                        record[race_idx] = race
-
-                    # Skip localness metric checks if no county (i.e., tweet isn't geotagged or is outside of US).
-                    if region:
-                        # n-day
-                        if user_regions[uid][region]:
-                            record[nday_idx] = True
-                        # plurality
-                        if region in user_regions[uid]['plurality']:
-                            record[plur_idx] = True
-                        # geometric median
-                        if region == user_regions[uid]['median']:
-                            record[geomed_idx] = True
-                        # location field
-                        try:
-                            loc_field_entry = tweet['user']['location']
-                            # location not found - make sure isn't a unicode issue
-                            if loc_field_entry and loc_field_entry not in locations:
-                                loc_field_entry = loc_field_entry.encode().decode('unicode-escape')
-                            # self-reported location exists and matches county of VGI
-                            if loc_field_entry and region in locations[loc_field_entry]:
-                                record[locfield_idx] = True
-                        except Exception:
-                            loc_failed += 1
-                            print("Lookup Failed:", loc_field_entry)
-                    csvwriter.writerow(record)
-                    count_processed += 1
-                except Exception as e:
-                    count_failed += 1
-                    print(e)
-                    print(record)
-                    traceback.print_exc()
-                if line_number % 100000 == 0:
-                    print_progress(line_number, count_failed, count_processed, count_gender, count_race, loc_failed)
-            print_progress(line_number, count_failed, count_processed, count_gender, count_race, loc_failed)
-            print("VGI read in from {0} and output to {1}.".format(INPUT_FN, OUTPUT_FN))
+        annotate(csvreader, csvwriter, LOOKUPS, counts, log, lambda: save_checkpoint(lines.offset, fout, counts))
+    return counts
+
+
+def annotate(records, csvwriter, lookups, counts, log=None, checkpoint=None):
+    """Append the EXTEND_COLUMNS to each input record and write it out, updating counts in place.
+
+    Time spent in each stage goes to counts['stages']. log, if given, is a ProgressLog written every PROGRESS_EVERY
+    lines and at the end. checkpoint, if given, is called every CHECKPOINT_EVERY lines after the line has been written.
+    """
+    timer = StageTimer(counts['stages'])
+    parser = TweetParser(LOCALNESS_FIELDS, JSON_BACKEND)  # only the user, geo, and created_at fields are kept
+    try:
+        tweet_idx = OUTPUT_COLUMNS.index('tweet')
+    except ValueError:
+        tweet_idx = -1
+    # alternatively replace the user_location_idx with the tweet if you have that full object and adjust code
+    #  to pull location field entry from tweet json object
+    county_idx = OUTPUT_COLUMNS.index('county')
+    extend_idx = {column: OUTPUT_COLUMNS.index(column) for column in EXTEND_COLUMNS}
+    default_extend_columns = [False for i in range(0, len(EXTEND_COLUMNS))]
+    t = time.perf_counter()
+    for record in records:
+        t = timer.time('csv_read', t)
+        counts['line_number'] += 1
+        try:
+            tweet = parser.parse(record[tweet_idx])
+            t = timer.time('json_parse', t)
+            uid = str(tweet['user']['id'])
+            record.extend(default_extend_columns)  # NOTE: using extend means that a copy is inserted
+            region = None if COMPUTE_COUNTY_FROM_LAT_LON else record[county_idx]
+            for column, value in label_tweet(tweet, uid, region, lookups, counts, timer).items():
+                record[extend_idx[column]] = value
+            t = time.perf_counter()
+            csvwriter.writerow(record)
+            timer.time('csv_write', t)
+            counts['processed'] += 1
+        except Exception as e:
+            counts['failed'] += 1
+            print(e)
+            print(record)
+            traceback.print_exc()
+        if counts['line_number'] % PROGRESS_EVERY == 0:
+            print_progress(counts['line_number'], counts['failed'], counts['processed'], counts['gender'],
+                           counts['race'], counts['loc_failed'])
+            if log is not None:
+                log.write(counts)
+        if checkpoint is not None and CHECKPOINT_EVERY and counts['line_number'] % CHECKPOINT_EVERY == 0:
+            checkpoint()
+        t = time.perf_counter()
+    if log is not None:
+        log.write(counts, final=True)
+
+
+def label_tweet(tweet, uid, region, lookups, counts, timer):
+    """Return {column: value} for the EXTEND_COLUMNS that a tweet sets (the rest stay False).
+
+    region is the precomputed county, used when COMPUTE_COUNTY_FROM_LAT_LON is off. Raises if the tweet can't be
+    labeled (e.g., its user has no nday rows for its county). Each lookup's time is charged to timer.
+    """
+    labels = {}
+    t = time.perf_counter()
+    if COMPUTE_COUNTY_FROM_LAT_LON:
+        if tweet['geo']:  # has coordinates
+            region = get_county(lookups['county_index'], tweet['geo']['coordinates'][0],
+                                tweet['geo']['coordinates'][1])
+        else:
+            region = None
+        t = timer.time('county_lookup', t)
+    if region:
+        region = region[:FIPS_LENGTH]
+    labels['county'] = region  # output file will reflect state or county scale
+
+    if COMPUTE_DEMOGRAPHICS:
+        gender = demographic_labeling.label_gender(tweet, lookups['males'], lookups['females'])
+        if gender != 'n':
+            counts['gender'] += 1
+        race = demographic_labeling.label_race_by_last_name(tweet, lookups['surnames_to_race'])
+        if race != 'n':
+            counts['race'] += 1
+        labels['gender'] = gender
+        labels['race'] = race
+        t = timer.time('demographics', t)
+
+    # Skip localness metric checks if no county (i.e., tweet isn't geotagged or is outside of US).
+    if region:
+        nday, plurality, geomed = lookups['user_regions'].lookup(uid, region)
+        t = timer.time('nday_plurality_geomed', t)
+        # n-day
+        if nday:
+            labels['nday'] = True
+        # plurality
+        if plurality:
+            labels['plurality'] = True
+        # geometric median
+        if geomed:
+            labels['geomed'] = True
+        # location field
+        locations = lookups['locations']
+        loc_field_entry = None
+        try:
+            loc_field_entry = tweet['user']['location']
+            # location not found - make sure isn't a unicode issue
+            if loc_field_entry and loc_field_entry not in locations:
+                loc_field_entry = loc_field_entry.encode().decode('unicode-escape')
+            # self-reported location exists and matches county of VGI
+            if loc_field_entry and region in locations[loc_field_entry]:
+                labels['locfield'] = True
+        except Exception:
+            counts['loc_failed'] += 1
+            print("Lookup Failed:", loc_field_entry)
+        timer.time('locfield', t)
+    return labels
+
+
+def annotate_columns(chunk_idx, lookups, counts):
+    """Label one chunk of the INPUT_COLUMNS_DIR store and write the EXTEND_COLUMNS for the same rows next to it.
+
+    Rows that fail are kept (so the chunks stay aligned) with processed set to False.
+    """
+    timer = StageTimer(counts['stages'])
+    t = time.perf_counter()
+    chunk = read_chunk(INPUT_COLUMNS_DIR, chunk_idx, ['uid', 'lat', 'lon', 'location', 'has_location', 'name'])
+    uids = chunk['uid'].tolist()
+    lats = chunk['lat'].tolist()
+    lons = chunk['lon'].tolist()
+    has_location = chunk['has_location'].tolist()
+    num_rows = len(uids)
+    columns = {'gender': [None] * num_rows, 'race': [None] * num_rows, 'county': [None] * num_rows}
+    for column in ['nday', 'plurality', 'geomed', 'locfield', 'processed']:
+        columns[column] = numpy.zeros(num_rows, dtype=bool)
+    timer.time('column_read', t)
+    start_line = counts['line_number']
+    log = ProgressLog(progress_log_fn(), 'columns chunk {0}'.format(chunk_idx),
+                      lambda: (counts['line_number'] - start_line) / float(num_rows or 1), start_line)
+    for i in range(0, num_rows):
+        counts['line_number'] += 1
+        geo = {'coordinates': [lats[i], lons[i]]} if lats[i] == lats[i] else None  # NaN if not geotagged
+        tweet = {'user': {'id': uids[i], 'name': chunk['name'][i]}, 'geo': geo}
+        if has_location[i]:  # left out if the tweet had no location key, so the lookup fails as it would from INPUT_FN
+            tweet['user']['location'] = chunk['location'][i]
+        try:
+            for column, value in label_tweet(tweet, str(uids[i]), None, lookups, counts, timer).items():
+                columns[column][i] = value
+            columns['processed'][i] = True
+            counts['processed'] += 1
+        except Exception as e:
+            counts['failed'] += 1
+            print(e)
+            print(tweet)
+            traceback.print_exc()
+        if counts['line_number'] % PROGRESS_EVERY == 0:
+            print_progress(counts['line_number'], counts['failed'], counts['processed'], counts['gender'],
+                           counts['race'], counts['loc_failed'])
+            log.write(counts)
+    t = time.perf_counter()
+    write_chunk(chunk_fn(INPUT_COLUMNS_DIR, 'localness', chunk_idx), columns)
+    timer.time('column_write', t)
+    log.write(counts, final=True)
+
+
+def chunk_offsets(input_fn, num_chunks, has_header):
+    """Split input_fn into about num_chunks byte ranges that start and end on line boundaries.
+
+    Assumes one record per line, which holds for CSVs of tweet JSON (JSON escapes newlines inside strings).
+    """
+    size = os.path.getsize(input_fn)
+    with open(input_fn, 'rb') as fin:
+        if has_header:
+            fin.readline()
+        offsets = [fin.tell()]
+        for i in range(1, num_chunks):
+            target = max(offsets[-1], size * i // num_chunks)
+            fin.seek(target)
+            if target > 0:
+                fin.readline()  # move to the start of the next line
+            if fin.tell() > offsets[-1] and fin.tell() < size:
+                offsets.append(fin.tell())
+    offsets.append(size)
+    return [(offsets[i], offsets[i + 1]) for i in range(0, len(offsets) - 1)]
+
+
+def annotate_chunk(chunk):
+    """Worker: annotate one byte range of INPUT_FN into its own shard file and return the counts.
+
+    COUNT_GEOTAGGED is left as it was; the chunk's share is in the returned counts for merge_counts. With --resume, a
+    chunk whose shard was finished is skipped.
+    """
+    global COUNT_GEOTAGGED
+    assert LOOKUPS, "LOOKUPS is empty: workers must be forked from main() after it is built"
+    chunk_idx, start, end = chunk
+    shard_fn = '{0}.part{1}'.format(OUTPUT_FN, chunk_idx)
+    counts = load_chunk_counts(shard_fn + '.counts', chunk)
+    if counts is None:
+        geotagged_before = COUNT_GEOTAGGED
+        counts = new_counts()
+        lines = OffsetLines(INPUT_FN, start, end)
+        log = ProgressLog(progress_log_fn(), 'chunk {0}'.format(chunk_idx),
+                          lambda: (lines.offset - start) / float(end - start or 1))
+        with open(shard_fn, 'w') as fout:
+            annotate(csv.reader(lines), csv.writer(fout), LOOKUPS, counts, log)
+            fout.flush()
+            os.fsync(fout.fileno())
+        counts['geotagged'] = COUNT_GEOTAGGED - geotagged_before
+        counts['peak_rss_mb'] = peak_rss_mb()
+        COUNT_GEOTAGGED = geotagged_before
+        save_chunk_counts(shard_fn + '.counts', chunk, counts)
+    return counts
+
+
+def column_counts_fn(chunk_idx):
+    return chunk_fn(INPUT_COLUMNS_DIR, 'localness', chunk_idx)[:-len('.npz')] + '.counts'
+
+
+def annotate_column_chunk(chunk_idx):
+    """Worker: label one chunk of the INPUT_COLUMNS_DIR store and return the counts (as annotate_chunk does)."""
+    global COUNT_GEOTAGGED
+    assert LOOKUPS, "LOOKUPS is empty: workers must be forked from main() after it is built"
+    counts = load_chunk_counts(column_counts_fn(chunk_idx), [chunk_idx])
+    if counts is None:
+        geotagged_before = COUNT_GEOTAGGED
+        counts = new_counts()
+        annotate_columns(chunk_idx, LOOKUPS, counts)
+        counts['geotagged'] = COUNT_GEOTAGGED - geotagged_before
+        counts['peak_rss_mb'] = peak_rss_mb()
+        COUNT_GEOTAGGED = geotagged_before
+        save_chunk_counts(column_counts_fn(chunk_idx), [chunk_idx], counts)
+    return counts
+
+
+def parallel_annotate():
+    """Annotate INPUT_FN (or the INPUT_COLUMNS_DIR chunks) in NUM_WORKERS processes and merge the shards in order."""
+    if INPUT_COLUMNS_DIR:
+        worker = annotate_column_chunk
+        tasks = list_chunks(INPUT_COLUMNS_DIR)
+    else:
+        worker = annotate_chunk
+        chunks = chunk_offsets(INPUT_FN, NUM_WORKERS * CHUNKS_PER_WORKER, INPUT_HAS_HEADER)
+        tasks = [(i, chunks[i][0], chunks[i][1]) for i in range(0, len(chunks))]
+    print("Annotating {0} chunks in {1} processes...".format(len(tasks), NUM_WORKERS))
+    # Always fork (not the platform default, spawn on macOS and forkserver from Python 3.14): workers inherit
+    # LOOKUPS and the command line options as module globals instead of re-importing the module with them unset.
+    pool = multiprocessing.get_context('fork').Pool(NUM_WORKERS)
+    counts = merge_counts(pool.imap_unordered(worker, tasks, 1), len(tasks))  # as chunks finish, for the progress log
+    pool.close()
+    pool.join()
+
+    if INPUT_COLUMNS_DIR:
+        remove_chunk_counts([column_counts_fn(chunk_idx) for chunk_idx in tasks])
+        return counts  # each chunk's results are already in the store
+
+    shard_fns = ['{0}.part{1}'.format(OUTPUT_FN, i) for i in range(0, len(chunks))]
+    remove_chunk_counts([shard_fn + '.counts' for shard_fn in shard_fns])
+    if MERGE_SHARDS:
+        with open(OUTPUT_FN, 'w') as fout:
+            csv.writer(fout).writerow(OUTPUT_COLUMNS)
+        with open(OUTPUT_FN, 'ab') as fout:
+            for shard_fn in shard_fns:
+                with open(shard_fn, 'rb') as fin:
+                    shutil.copyfileobj(fin, fout)
+                os.remove(shard_fn)
+    else:
+        print("Output left in {0} shards: {1}.part0 to {1}.part{2} (no header).".format(
+            len(shard_fns), OUTPUT_FN, len(shard_fns) - 1))
+    return counts
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
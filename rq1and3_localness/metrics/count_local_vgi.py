@@ -1,18 +1,63 @@
 import csv
-import json
 import argparse
+import os
 import sys
 
-sys.path.append*("./utils")
+sys.path.append("./utils")
 import bots
+from county_index import load_county_index
+from tweet_columns import iter_rows
 
 INPUT_HEADER = ['id', 'created_at', 'text', 'user_screen_name', 'user_description', 'user_lang', 'user_location',
                 'user_time_zone', 'geom_src', 'uid', 'tweet', 'lon', 'lat', 'gender', 'race',
                 'county', 'nday', 'plurality', 'geomed', 'locfield']
 
+def count_tweet(stats, twitter_bots, uid, n, p, g, l):
+    """Add a tweet to its county's stats by which of n-day, plurality, geomedian, and location field call it local."""
+    if uid in twitter_bots:
+        stats['bots'] += 1
+        return
+
+    if n and p and g and l:
+        stats['all'] += 1
+    elif not n and not p and not g and not l:
+        stats['none'] += 1
+
+    elif n and p and g:
+        stats['npg'] += 1
+    elif n and g and l:
+        stats['ngl'] += 1
+    elif n and p and l:
+        stats['npl'] += 1
+    elif p and g and l:
+        stats['pgl'] += 1
+
+    elif n and p:
+        stats['np'] += 1
+    elif n and g:
+        stats['ng'] += 1
+    elif n and l:
+        stats['nl'] += 1
+    elif p and g:
+        stats['pg'] += 1
+    elif p and l:
+        stats['pl'] += 1
+    elif g and l:
+        stats['gl'] += 1
+
+    elif n:
+        stats['nday'] += 1
+    elif p:
+        stats['plur'] += 1
+    elif g:
+        stats['geomed'] += 1
+    elif l:
+        stats['locfield'] += 1
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('localness_fn', help='CSV output from localness.py script')
+    parser.add_argument('localness_fn', help='CSV output from localness.py script (or its INPUT_COLUMNS_DIR store)')
     parser.add_argument('output_stats_fn', help="Path to CSV file output containing the localness stats by county")
     parser.add_argument('--filter_bots', default=True)
     args = parser.parse_args()
@@ -36,75 +81,37 @@ def main():
         tracking[output_header[i]] = 0
 
     county_stats = {}
-    with open("resources/USCounties_bare.geojson",'r') as fin:
-        counties = json.load(fin)
-
-    for county in counties['features']:
-        fips = str(county['properties']["FIPS"])
+    county_index = load_county_index()
+    for fips in county_index.fips:
+        fips = str(fips)
         county_stats[fips] = tracking.copy()
         county_stats[fips]['fips'] = fips
 
-    with open(localness_fn, 'r') as fin:
-        csvreader = csv.reader(fin)
-        assert next(csvreader) == INPUT_HEADER
+    if os.path.isdir(localness_fn):
         line_no = 0
-        for line in csvreader:
+        columns = ['processed', 'county', 'uid', 'nday', 'plurality', 'geomed', 'locfield']
+        for processed, fips, uid, n, p, g, l in iter_rows(localness_fn, columns):
+            if not processed:  # localness.py failed on the tweet, so it has no row in the CSV output
+                continue
             line_no += 1
-            fips = line[county_idx]
-            uid = line[uid_idx]
-            n, p, g, l = False, False, False, False
             if fips:
-                if uid in twitter_bots:
-                    county_stats[fips]['bots'] += 1
-                    continue
-
-                if line[nday_idx] == 'True':
-                    n = True
-                if line[plur_idx] == "True":
-                    p = True
-                if line[geomed_idx] == "True":
-                    g = True
-                if line[locfield_idx] == "True":
-                    l = True
-
-                if n and p and g and l:
-                    county_stats[fips]['all'] += 1
-                elif not n and not p and not g and not l:
-                    county_stats[fips]['none'] += 1
-
-                elif n and p and g:
-                    county_stats[fips]['npg'] += 1
-                elif n and g and l:
-                    county_stats[fips]['ngl'] += 1
-                elif n and p and l:
-                    county_stats[fips]['npl'] += 1
-                elif p and g and l:
-                    county_stats[fips]['pgl'] += 1
-
-                elif n and p:
-                    county_stats[fips]['np'] += 1
-                elif n and g:
-                    county_stats[fips]['ng'] += 1
-                elif n and l:
-                    county_stats[fips]['nl'] += 1
-                elif p and g:
-                    county_stats[fips]['pg'] += 1
-                elif p and l:
-                    county_stats[fips]['pl'] += 1
-                elif g and l:
-                    county_stats[fips]['gl'] += 1
-
-                elif n:
-                    county_stats[fips]['nday'] += 1
-                elif p:
-                    county_stats[fips]['plur'] += 1
-                elif g:
-                    county_stats[fips]['geomed'] += 1
-                elif l:
-                    county_stats[fips]['locfield'] += 1
-
+                count_tweet(county_stats[fips], twitter_bots, str(uid), n, p, g, l)
             if line_no % 100000 == 0:
                 print('{0} lines processed.'.format(line_no))
+    else:
+        with open(localness_fn, 'r') as fin:
+            csvreader = csv.reader(fin)
+            assert next(csvreader) == INPUT_HEADER
+            line_no = 0
+            for line in csvreader:
+                line_no += 1
+                fips = line[county_idx]
+                uid = line[uid_idx]
+                if fips:
+                    count_tweet(county_stats[fips], twitter_bots, uid, line[nday_idx] == 'True',
+                                line[plur_idx] == 'True', line[geomed_idx] == 'True', line[locfield_idx] == 'True')
+                if line_no % 100000 == 0:
+                    print('{0} lines processed.'.format(line_no))
 
     print('{0} total lines processed.'.format(line_no))
     with open(output_fn, "w") as fout:
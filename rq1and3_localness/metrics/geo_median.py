@@ -2,7 +2,17 @@
 #  with some help from https://github.com/ahwolf/meetup_location/blob/master/code/geo_median.py
 #  and adapted to support great circle distances over Euclidean.
 
+import argparse
 import csv
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+import zlib
+from collections import deque
 
 from geopy.distance import vincenty
 from geopy.distance import great_circle
@@ -14,8 +24,22 @@ LIMIT_POINTS = 5  # acceptable minimum number of GPS points for a user
 DISTANCE_THRESHOLD = 1  # distance (meters) between iterations that determines end of search
 DATA_POINTS_FILE = 'geo_median/{0}/user_points.csv'.format(VGI_REPOSITORY)
 OUTPUT_MEDIANS = 'geo_median/{0}/user_medians.csv'.format(VGI_REPOSITORY)
+PARTITION_MEMORY_FACTOR = 8  # rough bytes in memory as Python tuples per byte of user_points.csv
+MAX_PARTITIONS = 512  # cap on bucket files open at once when partitioning unsorted input
+USER_STATE_FILE = 'geo_median/{0}/user_state.csv'.format(VGI_REPOSITORY)  # per-user solver state for --incremental
 SNAP_TO_USER_POINTS = False
+SNAP_CANDIDATES = 32  # vectorized snapping only considers the user points nearest the continuous median (0 = all)
+MEDOID_BLOCK_SIZE = 1000000  # max candidate x point distances computed at once when snapping
 OUTPUT_ALL_USERS = True
+# per-user solver: 'vincenty' (geopy distances point by point), 'vectorized' (same distances as NumPy arrays), or
+#  'projected' (Newton steps in a local azimuthal equidistant plane)
+SOLVER = 'vincenty'
+EARTH_RADIUS_KM = 6371.009  # mean earth radius, same as geopy great_circle
+WGS84 = (6378.137, 6356.7523142, 1 / 298.257223563)  # major (km), minor (km), flattening - same as geopy vincenty
+VINCENTY_ITERATIONS = 20
+DEDUPLICATE_POINTS = True  # vectorized/batched solvers collapse repeated coordinates into weighted unique points
+MAX_USER_POINTS = 0  # keep a seeded reservoir sample of at most this many points per user (0 = keep all points)
+RESERVOIR_SEED = 2016
 
 
 def cand_median(dataPoints):
@@ -36,54 +60,518 @@ def check_median_absolute_deviation(data_points, median):
         try:
             distances.append(vincenty(median, data_points[i]).kilometers)
         except ValueError:
-            # Vincenty doesn't always converge so fall back on great circle distance which is less accurate but always converges
+            # Vincenty doesn't always converge so fall back on great circle distance which is less accurate but
+            #  always converges
             distances.append(great_circle(median, data_points[i]).kilometers)
     return(numpy.median(distances))
 
 
 def compute_user_median(data_points, num_iter, csvwriter, current_uid):
+    write_medians(csvwriter, [current_uid], [user_median(data_points, num_iter, current_uid)])
+
+
+def user_median(data_points, num_iter, current_uid, start_median=None, info=None):
+    """Return the user's median as (lat, lon), or None if too few points or the points are too spread out.
+
+    :param start_median: optional warm start for Weiszfeld instead of the centroid
+    :param info: optional dict filled in with the solver's 'median', 'iterations', and 'converged'
+    """
     if len(data_points) < LIMIT_POINTS:  # Insufficient points for the user - don't record median
-        if OUTPUT_ALL_USERS:
-            csvwriter.writerow([current_uid, None])
+        return None
+    if info is None:
+        info = {}
+    if SOLVER in ('vectorized', 'projected'):
+        points, weights = dedupe_points(data_points)
+    if SNAP_TO_USER_POINTS and SOLVER == 'vectorized':
+        median = vectorized_median(points, num_iter, current_uid, weights, start_median, info)
+        test_median = vectorized_medoid(points, weights, median)
+    elif SNAP_TO_USER_POINTS and SOLVER == 'projected':
+        median = projected_median(points, num_iter, current_uid, weights, start_median, info)
+        test_median = vectorized_medoid(points, weights, median)
+    elif SNAP_TO_USER_POINTS: # ensure median is one of the user's points
+        test_median = geopy_medoid(data_points)
+        info.update({'median': test_median, 'iterations': 0, 'converged': True})
+    elif SOLVER == 'vectorized':
+        test_median = vectorized_median(points, num_iter, current_uid, weights, start_median, info)
+    elif SOLVER == 'projected':
+        test_median = projected_median(points, num_iter, current_uid, weights, start_median, info)
+    else:
+        test_median = weiszfeld_median(data_points, num_iter, current_uid, start_median, info)
+
+    # Check if user points are under the limit median absolute deviation
+    if SOLVER in ('vectorized', 'projected'):
+        mad = vectorized_median_absolute_deviation(points, test_median, weights)
+    else:
+        mad = check_median_absolute_deviation(data_points, test_median)
+    if mad <= LIMIT_MAD:
+        return test_median
+    return None
+
+
+def geopy_medoid(data_points):
+    """User point with the lowest sum of distances to all the user's points, checking every pair with geopy."""
+    lowest_dev = float("inf")
+    for point in data_points:
+        tmp_abs_dev = objfunc(point, data_points)
+        if tmp_abs_dev < lowest_dev:
+            lowest_dev = tmp_abs_dev
+            test_median = point
+    return test_median
+
+
+def vectorized_medoid(data_points, point_weights, median, num_candidates=None):
+    """User point with the lowest (weighted) sum of distances to all the user's points.
+
+    Only the num_candidates points closest to the continuous median are evaluated (all points if 0), as full
+    candidate x point distance matrices computed in blocks of at most MEDOID_BLOCK_SIZE entries.
+    """
+    if num_candidates is None:
+        num_candidates = SNAP_CANDIDATES
+    lats = data_points[:, 0]
+    lons = data_points[:, 1]
+    if point_weights is None:
+        point_weights = numpy.ones(len(lats))
+    if num_candidates and len(lats) > num_candidates:
+        distances = vincenty_km(median[0], median[1], lats, lons)
+        candidates = numpy.sort(numpy.argpartition(distances, num_candidates - 1)[:num_candidates])
+    else:
+        candidates = numpy.arange(len(lats))
+
+    block = max(1, MEDOID_BLOCK_SIZE // len(lats))
+    lowest_dev = float("inf")
+    for start in range(0, len(candidates), block):
+        block_candidates = candidates[start:start + block]
+        distances = vincenty_km(numpy.repeat(lats[block_candidates], len(lats)),
+                                numpy.repeat(lons[block_candidates], len(lats)),
+                                numpy.tile(lats, len(block_candidates)), numpy.tile(lons, len(block_candidates)))
+        abs_devs = numpy.dot(distances.reshape(len(block_candidates), len(lats)), point_weights)
+        j = numpy.argmin(abs_devs)
+        if abs_devs[j] < lowest_dev:
+            lowest_dev = abs_devs[j]
+            test_median = (float(lats[block_candidates[j]]), float(lons[block_candidates[j]]))
+    return test_median
+
+
+def weiszfeld_median(data_points, num_iter, current_uid, start_median=None, info=None):
+    """Weiszfeld's algorithm with geopy distances computed one point at a time."""
+    if start_median:
+        test_median = start_median
     else:
-        if SNAP_TO_USER_POINTS: # ensure median is one of the user's points
-            lowest_dev = float("inf")
-            for point in data_points:
-                tmp_abs_dev = objfunc(point, data_points)
-                if tmp_abs_dev < lowest_dev:
-                    lowest_dev = tmp_abs_dev
-                    test_median = point
-        else:
-            test_median = cand_median(data_points)  # Calculate centroid more or less as starting point
-            if objfunc(test_median, data_points) != 0:  # points aren't all the same
-                # iterate to find reasonable estimate of median
-                for x in range(0, num_iter):
-                    denom = denomsum(test_median, data_points)
-                    next_lat = 0.0
-                    next_lon = 0.0
-
-                    for y in range(0, len(data_points)):
-                        next_lat += (data_points[y][0] * numersum(test_median, data_points[y])) / denom
-                        next_lon += (data_points[y][1] * numersum(test_median, data_points[y])) / denom
-
-                    prev_median = test_median
-                    test_median = (next_lat, next_lon)
-                    try:
-                        if vincenty(prev_median, test_median).meters < DISTANCE_THRESHOLD:
-                            break
-                    except:
-                        if great_circle(prev_median, test_median).meters < DISTANCE_THRESHOLD:
-                            break
-
-                if x == num_iter - 1:
-                    print('{0}: failed to converge. Last change between iterations was {1} meters.'.format(current_uid, great_circle(prev_median, test_median).meters))
-
-        # Check if user points are under the limit median absolute deviation
-        if check_median_absolute_deviation(data_points, test_median) <= LIMIT_MAD:
-            csvwriter.writerow([current_uid, (round(test_median[0],6), round(test_median[1],6))])
-        else:
-            if OUTPUT_ALL_USERS:
-                csvwriter.writerow([current_uid, None])
+        test_median = cand_median(data_points)  # Calculate centroid more or less as starting point
+    x = -1
+    converged = True
+    if objfunc(test_median, data_points) != 0:  # points aren't all the same
+        # iterate to find reasonable estimate of median
+        for x in range(0, num_iter):
+            denom = denomsum(test_median, data_points)
+            next_lat = 0.0
+            next_lon = 0.0
+
+            for y in range(0, len(data_points)):
+                next_lat += (data_points[y][0] * numersum(test_median, data_points[y])) / denom
+                next_lon += (data_points[y][1] * numersum(test_median, data_points[y])) / denom
+
+            prev_median = test_median
+            test_median = (next_lat, next_lon)
+            try:
+                if vincenty(prev_median, test_median).meters < DISTANCE_THRESHOLD:
+                    break
+            except:
+                if great_circle(prev_median, test_median).meters < DISTANCE_THRESHOLD:
+                    break
+
+        if x == num_iter - 1:
+            converged = great_circle(prev_median, test_median).meters < DISTANCE_THRESHOLD
+            print('{0}: failed to converge. Last change between iterations was {1} meters.'.format(
+                current_uid, great_circle(prev_median, test_median).meters))
+    if info is not None:
+        info.update({'median': test_median, 'iterations': x + 1, 'converged': converged})
+    return test_median
+
+
+def haversine_km(lat, lon, lats, lons):
+    """Great circle distance (km) from (lat, lon) to every point in the lats/lons arrays."""
+    lat = numpy.radians(lat)
+    lats = numpy.radians(lats)
+    dlat = lats - lat
+    dlon = numpy.radians(lons) - numpy.radians(lon)
+    a = numpy.sin(dlat / 2) ** 2 + numpy.cos(lat) * numpy.cos(lats) * numpy.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+def vincenty_km(lat, lon, lats, lons):
+    """Vincenty ellipsoidal distance (km) from (lat, lon) to every point in the lats/lons arrays.
+
+    Follows geopy's vincenty term for term, iterating all points at once. Points where the formula doesn't
+    converge fall back on great circle distance, as in the geopy-based functions below.
+    """
+    major, minor, f = WGS84
+    lats = numpy.atleast_1d(numpy.asarray(lats, dtype=numpy.float64))
+    lons = numpy.atleast_1d(numpy.asarray(lons, dtype=numpy.float64))
+    delta_lng = numpy.radians(lons) - numpy.radians(lon)
+    reduced_lat1 = numpy.arctan((1 - f) * numpy.tan(numpy.radians(lat)))
+    reduced_lat2 = numpy.arctan((1 - f) * numpy.tan(numpy.radians(lats)))
+    sin_reduced1, cos_reduced1 = numpy.sin(reduced_lat1), numpy.cos(reduced_lat1)
+    sin_reduced2, cos_reduced2 = numpy.sin(reduced_lat2), numpy.cos(reduced_lat2)
+
+    lambda_lng = delta_lng
+    converged = numpy.zeros(len(lats), dtype=bool)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for i in range(0, VINCENTY_ITERATIONS + 1):
+            sin_lambda_lng, cos_lambda_lng = numpy.sin(lambda_lng), numpy.cos(lambda_lng)
+            sin_sigma = numpy.sqrt((cos_reduced2 * sin_lambda_lng) ** 2 +
+                                   (cos_reduced1 * sin_reduced2 - sin_reduced1 * cos_reduced2 * cos_lambda_lng) ** 2)
+            cos_sigma = sin_reduced1 * sin_reduced2 + cos_reduced1 * cos_reduced2 * cos_lambda_lng
+            sigma = numpy.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = cos_reduced1 * cos_reduced2 * sin_lambda_lng / sin_sigma
+            cos_sq_alpha = 1 - sin_alpha ** 2
+            cos2_sigma_m = numpy.where(cos_sq_alpha != 0,
+                                       cos_sigma - 2 * (sin_reduced1 * sin_reduced2 / cos_sq_alpha), 0.0)
+            C = f / 16. * cos_sq_alpha * (4 + f * (4 - 3 * cos_sq_alpha))
+            next_lambda_lng = delta_lng + (1 - C) * f * sin_alpha * (
+                sigma + C * sin_sigma * (cos2_sigma_m + C * cos_sigma * (-1 + 2 * cos2_sigma_m ** 2)))
+            # coincident points are done on the first pass
+            newly_converged = ~converged & ((numpy.abs(next_lambda_lng - lambda_lng) <= 10e-12) | (sin_sigma == 0))
+            # converged points keep the lambda their terms were computed from so later passes reproduce them exactly
+            lambda_lng = numpy.where(converged | newly_converged, lambda_lng, next_lambda_lng)
+            converged |= newly_converged
+            if converged.all():
+                break
+
+        u_sq = cos_sq_alpha * (major ** 2 - minor ** 2) / minor ** 2
+        A = 1 + u_sq / 16384. * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+        B = u_sq / 1024. * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+        delta_sigma = B * sin_sigma * (cos2_sigma_m + B / 4. * (
+            cos_sigma * (-1 + 2 * cos2_sigma_m ** 2) -
+            B / 6. * cos2_sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos2_sigma_m ** 2)))
+        distances = minor * A * (sigma - delta_sigma)
+    distances = numpy.where(sin_sigma == 0, 0.0, distances)
+    if not converged.all():
+        distances = numpy.where(converged, distances, haversine_km(lat, lon, lats, lons))
+    return distances
+
+
+def dedupe_points(data_points):
+    """Return an (n, 2) array of the user's points and their multiplicities (None if not deduplicating)."""
+    if not DEDUPLICATE_POINTS:
+        return numpy.asarray(data_points, dtype=numpy.float64), None
+    points, counts = numpy.unique(numpy.asarray(data_points, dtype=numpy.float64), axis=0, return_counts=True)
+    return points, counts.astype(numpy.float64)
+
+
+def weighted_median(values, weights):
+    """Same result as numpy.median on the values repeated according to their integer weights."""
+    order = numpy.argsort(values, kind='stable')
+    values = values[order]
+    cumulative = numpy.cumsum(weights[order])
+    total = int(cumulative[-1])
+    lower = values[numpy.searchsorted(cumulative, (total - 1) // 2, side='right')]
+    upper = values[numpy.searchsorted(cumulative, total // 2, side='right')]
+    return (lower + upper) / 2
+
+
+def vectorized_median(data_points, num_iter, current_uid, point_weights=None, start_median=None, info=None):
+    """Weiszfeld's algorithm on an (n, 2) array of lat/lon with all distances for an iteration computed at once.
+
+    point_weights gives the multiplicity of each point when duplicates have been collapsed.
+    start_median and info are as in user_median.
+    """
+    lats = data_points[:, 0]
+    lons = data_points[:, 1]
+    if point_weights is None:
+        point_weights = numpy.ones(len(lats))
+    if start_median:
+        test_median = start_median
+    else:
+        test_median = (numpy.dot(point_weights, lats) / point_weights.sum(),
+                       numpy.dot(point_weights, lons) / point_weights.sum())
+    distances = vincenty_km(test_median[0], test_median[1], lats, lons)
+    if not distances.any():  # median sits on every point
+        test_median = (float(test_median[0]), float(test_median[1]))
+        if info is not None:
+            info.update({'median': test_median, 'iterations': 0, 'converged': True})
+        return test_median
+    for x in range(0, num_iter):
+        # points that equal the median are filtered out (otherwise no convergence)
+        weights = numpy.divide(point_weights, distances, out=numpy.zeros_like(distances), where=distances > 0)
+        denom = weights.sum()
+        prev_median = test_median
+        test_median = (numpy.dot(weights, lats) / denom, numpy.dot(weights, lons) / denom)
+        step = vincenty_km(prev_median[0], prev_median[1], test_median[0], test_median[1])[0] * 1000
+        if step < DISTANCE_THRESHOLD:
+            break
+        distances = vincenty_km(test_median[0], test_median[1], lats, lons)
+    if x == num_iter - 1:
+        print('{0}: failed to converge. Last change between iterations was {1} meters.'.format(current_uid, step))
+    test_median = (float(test_median[0]), float(test_median[1]))
+    if info is not None:
+        info.update({'median': test_median, 'iterations': x + 1, 'converged': step < DISTANCE_THRESHOLD})
+    return test_median
+
+
+def azimuthal_equidistant(center, lats, lons):
+    """Project lat/lon onto a plane (km) tangent at center that preserves distances and bearings from center."""
+    lat0, lon0 = numpy.radians(center[0]), numpy.radians(center[1])
+    lats = numpy.radians(lats)
+    dlons = numpy.radians(lons) - lon0
+    cos_c = numpy.clip(numpy.sin(lat0) * numpy.sin(lats) + numpy.cos(lat0) * numpy.cos(lats) * numpy.cos(dlons), -1, 1)
+    c = numpy.arccos(cos_c)
+    k = numpy.where(c > 0, c / numpy.sin(numpy.where(c > 0, c, 1)), 1.0) * EARTH_RADIUS_KM
+    x = k * numpy.cos(lats) * numpy.sin(dlons)
+    y = k * (numpy.cos(lat0) * numpy.sin(lats) - numpy.sin(lat0) * numpy.cos(lats) * numpy.cos(dlons))
+    return x, y
+
+
+def inverse_azimuthal_equidistant(center, x, y):
+    """Map a point in the azimuthal equidistant plane around center back to (lat, lon)."""
+    lat0, lon0 = numpy.radians(center[0]), numpy.radians(center[1])
+    rho = numpy.hypot(x, y)
+    if rho == 0:
+        return (float(center[0]), float(center[1]))
+    c = rho / EARTH_RADIUS_KM
+    lat = numpy.arcsin(numpy.cos(c) * numpy.sin(lat0) + y * numpy.sin(c) * numpy.cos(lat0) / rho)
+    lon = lon0 + numpy.arctan2(x * numpy.sin(c),
+                               rho * numpy.cos(lat0) * numpy.cos(c) - y * numpy.sin(lat0) * numpy.sin(c))
+    return (float(numpy.degrees(lat)), float((numpy.degrees(lon) + 180) % 360 - 180))
+
+
+def projected_median(data_points, num_iter, current_uid, point_weights=None, start_median=None, info=None):
+    """Geometric median in a local azimuthal equidistant plane using safeguarded Newton steps.
+
+    Points are projected once around the starting point, so each iteration is plain Euclidean arithmetic on 2x2
+    matrices. A Newton step is taken when it lowers the sum of distances, otherwise the Weiszfeld step (which always
+    does), and the search stops early when the nearest user point satisfies the optimality condition. This minimizes
+    true distances, so users spread over many km can land a little away from the degree-space Weiszfeld solvers.
+    Arguments are as in vectorized_median.
+    """
+    lats = data_points[:, 0]
+    lons = data_points[:, 1]
+    if point_weights is None:
+        point_weights = numpy.ones(len(lats))
+    if start_median:
+        center = start_median
+    else:
+        center = (numpy.dot(point_weights, lats) / point_weights.sum(),
+                  numpy.dot(point_weights, lons) / point_weights.sum())
+    xs, ys = azimuthal_equidistant(center, lats, lons)
+    x, y = 0.0, 0.0
+    distances = numpy.hypot(xs - x, ys - y)
+    objective = numpy.dot(point_weights, distances)
+    iterations = 0
+    converged = True
+    if distances.any():  # otherwise the median sits on every point
+        threshold_km = DISTANCE_THRESHOLD / 1000.0
+        for iterations in range(1, num_iter + 1):
+            # points that equal the median are filtered out (otherwise no convergence)
+            weights = numpy.divide(point_weights, distances, out=numpy.zeros_like(distances), where=distances > 0)
+            denom = weights.sum()
+            dxs = x - xs
+            dys = y - ys
+            grad_x = numpy.dot(weights, dxs)
+            grad_y = numpy.dot(weights, dys)
+            # Hessian of the sum of distances: sum of w / d * (I - u u^T) for unit vectors u toward the median
+            curvature = numpy.divide(weights, distances * distances, out=numpy.zeros_like(distances),
+                                     where=distances > 0)
+            h_xx = denom - numpy.dot(curvature, dxs * dxs)
+            h_yy = denom - numpy.dot(curvature, dys * dys)
+            h_xy = -numpy.dot(curvature, dxs * dys)
+            det = h_xx * h_yy - h_xy * h_xy
+            candidates = []
+            if det > 0:
+                candidates.append((x - (h_yy * grad_x - h_xy * grad_y) / det,
+                                   y - (h_xx * grad_y - h_xy * grad_x) / det))
+            candidates.append((x - grad_x / denom, y - grad_y / denom))  # Weiszfeld step
+            for next_x, next_y in candidates:
+                next_distances = numpy.hypot(xs - next_x, ys - next_y)
+                next_objective = numpy.dot(point_weights, next_distances)
+                if next_objective <= objective:
+                    break
+            step = numpy.hypot(next_x - x, next_y - y)
+            x, y, distances, objective = next_x, next_y, next_distances, next_objective
+            if step < threshold_km:
+                break
+            # both steps crawl when the median is one of the points, so stop once the nearest point is optimal:
+            #  the pull of all other points on it must not exceed its own weight
+            nearest = numpy.argmin(distances)
+            to_nearest = numpy.hypot(xs[nearest] - xs, ys[nearest] - ys)
+            pull = numpy.divide(point_weights, to_nearest, out=numpy.zeros_like(to_nearest), where=to_nearest > 0)
+            residual = numpy.hypot(numpy.dot(pull, xs[nearest] - xs), numpy.dot(pull, ys[nearest] - ys))
+            if residual <= point_weights[nearest]:
+                step = 0.0
+                x, y = xs[nearest], ys[nearest]
+                break
+        converged = step < threshold_km
+        if not converged:
+            print('{0}: failed to converge. Last change between iterations was {1} meters.'.format(
+                current_uid, step * 1000))
+    test_median = inverse_azimuthal_equidistant(center, x, y)
+    if info is not None:
+        info.update({'median': test_median, 'iterations': iterations, 'converged': converged})
+    return test_median
+
+
+def vectorized_median_absolute_deviation(data_points, median, point_weights=None):
+    """Median Absolute Deviation (km) of an (n, 2) array of points, weighted by multiplicity if given."""
+    distances = vincenty_km(median[0], median[1], data_points[:, 0], data_points[:, 1])
+    if point_weights is None:
+        return numpy.median(distances)
+    return weighted_median(distances, point_weights)
+
+
+def batched_medians(users, num_iter):
+    """Compute medians for many users at once from ragged arrays of their points.
+
+    All eligible users' points are packed into flat lat/lon arrays with a segment (user) id per point. Each Weiszfeld
+    iteration is a handful of array operations plus segmented sums, and users drop out of the active set as they
+    converge. The LIMIT_POINTS and LIMIT_MAD filters are applied in bulk.
+
+    :param users: list of (uid, data_points)
+    :return: list with a (lat, lon) median or None for each user, in the same order
+    """
+    medians = [None] * len(users)
+    eligible = numpy.array([i for i in range(0, len(users)) if len(users[i][1]) >= LIMIT_POINTS], dtype=numpy.int64)
+    if not len(eligible):
+        return medians
+    deduped = [dedupe_points(users[i][1]) for i in eligible]
+    counts = numpy.array([len(points) for points, weights in deduped], dtype=numpy.int64)
+    offsets = numpy.zeros(len(eligible) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum(counts)
+    points = numpy.concatenate([points for points, weights in deduped])
+    if DEDUPLICATE_POINTS:
+        point_weights = numpy.concatenate([weights for points, weights in deduped])
+    else:
+        point_weights = numpy.ones(len(points))
+    del(deduped)
+    lats = points[:, 0]
+    lons = points[:, 1]
+    segments = numpy.repeat(numpy.arange(len(eligible)), counts)
+    total_weights = numpy.add.reduceat(point_weights, offsets[:-1])
+
+    # centroid as starting point
+    med_lats = numpy.add.reduceat(point_weights * lats, offsets[:-1]) / total_weights
+    med_lons = numpy.add.reduceat(point_weights * lons, offsets[:-1]) / total_weights
+
+    # users whose points are all the same are done before the first iteration
+    distances = vincenty_km(med_lats[segments], med_lons[segments], lats, lons)
+    active = numpy.bincount(segments, weights=(distances > 0), minlength=len(eligible)) > 0
+    act_users = numpy.nonzero(active)[0]
+    act_points = active[segments]
+    act_lats = lats[act_points]
+    act_lons = lons[act_points]
+    act_weights = point_weights[act_points]
+    act_distances = distances[act_points]
+    act_segments = numpy.searchsorted(act_users, segments[act_points])  # segment ids renumbered within active set
+
+    for x in range(0, num_iter):
+        if not len(act_users):
+            break
+        # points that equal the median are filtered out (otherwise no convergence)
+        weights = numpy.divide(act_weights, act_distances, out=numpy.zeros_like(act_distances), where=act_distances > 0)
+        denom = numpy.bincount(act_segments, weights=weights, minlength=len(act_users))
+        prev_lats = med_lats[act_users]
+        prev_lons = med_lons[act_users]
+        med_lats[act_users] = numpy.bincount(act_segments, weights=weights * act_lats, minlength=len(act_users)) / denom
+        med_lons[act_users] = numpy.bincount(act_segments, weights=weights * act_lons, minlength=len(act_users)) / denom
+        steps = vincenty_km(prev_lats, prev_lons, med_lats[act_users], med_lons[act_users]) * 1000
+        still_active = steps >= DISTANCE_THRESHOLD
+        if not still_active.all():
+            # compact the point arrays down to the users that haven't converged
+            keep_points = still_active[act_segments]
+            act_lats = act_lats[keep_points]
+            act_lons = act_lons[keep_points]
+            act_weights = act_weights[keep_points]
+            act_segments = numpy.cumsum(still_active)[act_segments[keep_points]] - 1
+            act_users = act_users[still_active]
+            steps = steps[still_active]
+        act_distances = vincenty_km(med_lats[act_users][act_segments], med_lons[act_users][act_segments],
+                                    act_lats, act_lons)
+    for i in range(0, len(act_users)):
+        print('{0}: failed to converge. Last change between iterations was {1} meters.'.format(
+            users[eligible[act_users[i]]][0], steps[i]))
+
+    if SNAP_TO_USER_POINTS:
+        for j in range(0, len(eligible)):
+            start, end = offsets[j], offsets[j + 1]
+            med_lats[j], med_lons[j] = vectorized_medoid(points[start:end], point_weights[start:end],
+                                                         (med_lats[j], med_lons[j]))
+
+    # weighted median absolute deviation per user from the points sorted by distance within each segment
+    distances = vincenty_km(med_lats[segments], med_lons[segments], lats, lons)
+    order = numpy.lexsort((distances, segments))
+    sorted_distances = distances[order]
+    cumulative = numpy.cumsum(point_weights[order])
+    before = cumulative[offsets[:-1]] - point_weights[order][offsets[:-1]]  # total weight of earlier segments
+    total_weights = total_weights.astype(numpy.int64)
+    lower = sorted_distances[numpy.searchsorted(cumulative, before + (total_weights - 1) // 2, side='right')]
+    upper = sorted_distances[numpy.searchsorted(cumulative, before + total_weights // 2, side='right')]
+    mads = (lower + upper) / 2
+    for j in numpy.nonzero(mads <= LIMIT_MAD)[0]:
+        medians[eligible[j]] = (float(med_lats[j]), float(med_lons[j]))
+    return medians
+
+
+def write_medians(csvwriter, uids, medians):
+    for i in range(0, len(uids)):
+        if medians[i]:
+            csvwriter.writerow([uids[i], (round(medians[i][0],6), round(medians[i][1],6))])
+        elif OUTPUT_ALL_USERS:
+            csvwriter.writerow([uids[i], None])
+
+
+def chunk_users(users, chunk_size):
+    """Group an iterable of (uid, data_points) into lists of at most chunk_size users."""
+    chunk = []
+    for user in users:
+        chunk.append(user)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def set_options(options):
+    """Set module-level solver options (also the pool initializer so workers use the command line options)."""
+    globals().update(options)
+
+
+def solve_chunk(users, num_iter, batched):
+    """Worker task: medians for a chunk of users, returned with their uids so the points needn't be kept around."""
+    uids = [user[0] for user in users]
+    if batched:
+        return uids, batched_medians(users, num_iter)
+    return uids, [user_median(data_points, num_iter, uid) for uid, data_points in users]
+
+
+def current_options():
+    return {'SOLVER': SOLVER, 'DEDUPLICATE_POINTS': DEDUPLICATE_POINTS, 'SNAP_TO_USER_POINTS': SNAP_TO_USER_POINTS,
+            'SNAP_CANDIDATES': SNAP_CANDIDATES}
+
+
+def parallel_medians(csvwriter, users, num_iter, workers, chunk_size, batched):
+    """Stream chunks of users to a process pool and write results in input order.
+
+    At most 2 * workers chunks are in flight at once, so memory stays flat regardless of input size.
+    """
+    count = 0
+    pending = deque()
+    pool = multiprocessing.Pool(workers, initializer=set_options, initargs=(current_options(),))
+    try:
+        for chunk in chunk_users(users, chunk_size):
+            pending.append(pool.apply_async(solve_chunk, (chunk, num_iter, batched)))
+            if len(pending) >= 2 * workers:
+                uids, medians = pending.popleft().get()
+                write_medians(csvwriter, uids, medians)
+                count += len(uids)
+                print("Processed {0} users.".format(count))
+        while pending:
+            uids, medians = pending.popleft().get()
+            write_medians(csvwriter, uids, medians)
+            count += len(uids)
+        print("Processed {0} users.".format(count))
+    finally:
+        pool.close()
+        pool.join()
 
 
 def denomsum(test_median, data_points):
@@ -95,19 +583,23 @@ def denomsum(test_median, data_points):
         except ZeroDivisionError:
             continue  # filter points that equal the median out (otherwise no convergence)
         except ValueError:
-            # Vincenty doesn't always converge so fall back on great circle distance which is less accurate but always converges
+            # Vincenty doesn't always converge so fall back on great circle distance which is less accurate but
+            #  always converges
             temp += 1 / great_circle(test_median, data_points[i]).kilometers
     return temp
 
 
 def numersum(test_median, data_point):
-    """Provides the denominator of the weiszfeld algorithm depending on whether you are adjusting the candidate x or y."""
+    """Provides the denominator of the weiszfeld algorithm depending on whether you are adjusting the candidate x
+    or y.
+    """
     try:
         return 1 / vincenty(test_median, data_point).kilometers
     except ZeroDivisionError:
         return 0  # filter points that equal the median out (otherwise no convergence)
     except ValueError:
-        # Vincenty doesn't always converge so fall back on great circle distance which is less accurate but always converges
+        # Vincenty doesn't always converge so fall back on great circle distance which is less accurate but
+        #  always converges
         return 1 / great_circle(test_median, data_point).kilometers
 
 
@@ -120,37 +612,398 @@ def objfunc(test_median, data_points):
         try:
             temp += vincenty(test_median, data_points[i]).kilometers
         except ValueError:
-            # Vincenty doesn't always converge so fall back on great circle distance which is less accurate but always converges
+            # Vincenty doesn't always converge so fall back on great circle distance which is less accurate but
+            #  always converges
             temp += great_circle(test_median, data_points[i]).kilometers
     return temp
 
 
-def main(iterations=1000):
-    count = 0
-    with open(DATA_POINTS_FILE, 'r') as fin:
+def read_user_points(points_fn):
+    """Yield (uid, [(lat, lon), ...]) for each run of consecutive rows with the same uid."""
+    with open(points_fn, 'r') as fin:
         csvreader = csv.reader(fin)
         assert next(csvreader) == ['uid','lat','lon']
-        with open(OUTPUT_MEDIANS, 'w') as fout:
-            csvwriter = csv.writer(fout)
-            csvwriter.writerow(['uid','median'])
-            line = next(csvreader)
-            data_points = [(float(line[1]), float(line[2]))]
-            current_uid = line[0]
+        line = next(csvreader)
+        data_points = [(float(line[1]), float(line[2]))]
+        current_uid = line[0]
+        for line in csvreader:
+            if line[0] == current_uid:
+                data_points.append((float(line[1]), float(line[2])))
+            else:
+                yield current_uid, data_points
+
+                # set user and restart array for new current user
+                current_uid = line[0]
+                data_points = [(float(line[1]), float(line[2]))]
+        # final user
+        yield current_uid, data_points
+
+
+def reservoir_sample(data_points, max_points, uid, seed=None):
+    """Return at most max_points of the user's points, chosen by reservoir sampling (Algorithm R) in input order.
+
+    The random stream is seeded with the uid so a user's sample doesn't depend on which other users were read first.
+    seed defaults to RESERVOIR_SEED at call time.
+    """
+    if len(data_points) <= max_points:
+        return data_points
+    if seed is None:
+        seed = RESERVOIR_SEED
+    rng = random.Random('{0}:{1}'.format(seed, uid))
+    reservoir = list(range(0, max_points))
+    for i in range(max_points, len(data_points)):
+        j = rng.randint(0, i)
+        if j < max_points:
+            reservoir[j] = i
+    return [data_points[i] for i in sorted(reservoir)]
+
+
+def cap_user_points(users, max_points, seed=None):
+    """Apply reservoir_sample to each (uid, data_points) in a stream of users."""
+    for uid, data_points in users:
+        yield uid, reservoir_sample(data_points, max_points, uid, seed)
+
+
+def point_digest(data_points):
+    """Order-independent checksum of a user's points so unchanged users can be recognized between runs."""
+    digest = 0
+    for lat, lon in data_points:
+        digest += zlib.crc32('{0!r},{1!r}'.format(lat, lon).encode())
+    return digest
+
+
+STATE_COLUMNS = ['uid', 'num_points', 'digest', 'lat', 'lon', 'converged', 'median']
+
+
+def incremental_settings(num_iter, max_user_points=0, seed=None):
+    """Options that change a user's median; a state file written under different settings isn't reused."""
+    return {'SOLVER': SOLVER, 'SNAP_TO_USER_POINTS': SNAP_TO_USER_POINTS, 'SNAP_CANDIDATES': SNAP_CANDIDATES,
+            'DEDUPLICATE_POINTS': DEDUPLICATE_POINTS, 'LIMIT_MAD': LIMIT_MAD, 'LIMIT_POINTS': LIMIT_POINTS,
+            'DISTANCE_THRESHOLD': DISTANCE_THRESHOLD, 'num_iter': num_iter, 'max_user_points': max_user_points,
+            'reservoir_seed': (RESERVOIR_SEED if seed is None else seed) if max_user_points > 0 else None}
+
+
+class UserState(object):
+    """Per-user rows of the state file written by incremental_medians, looked up by uid.
+
+    Only a uid -> byte offset index is kept in memory; a user's row is read from the file when it is looked up. The
+    state is empty if there's no state file or it was written with different settings (or by an older version that
+    didn't record them).
+    """
+
+    def __init__(self, state_fn, settings):
+        self.offsets = {}
+        self.fin = None
+        if not os.path.exists(state_fn):
+            return
+        self.fin = open(state_fn, 'rb')
+        line = next(csv.reader([self.fin.readline().decode('utf-8')]), None)
+        if not line or line[0] != 'settings' or json.loads(line[1]) != settings:
+            print("Ignoring {0}: it was written with different settings than {1}.".format(state_fn, settings))
+            return
+        assert next(csv.reader([self.fin.readline().decode('utf-8')])) == STATE_COLUMNS
+        offset = self.fin.tell()
+        for line in self.fin:
+            self.offsets[line.split(b',', 1)[0].decode('utf-8')] = offset
+            offset += len(line)
+        print("{0} users indexed in {1}.".format(len(self.offsets), state_fn))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def pop(self, uid):
+        """Return the user's row and forget it (so what's left are users no longer in the input), or None."""
+        offset = self.offsets.pop(uid, None)
+        if offset is None:
+            return None
+        self.fin.seek(offset)
+        return next(csv.reader([self.fin.readline().decode('utf-8')]))
+
+    def close(self):
+        if self.fin:
+            self.fin.close()
+
+
+def incremental_medians(csvwriter, users, num_iter, state_fn, max_user_points=0, seed=None):
+    """Reuse last run's result for users whose points haven't changed and warm-start Weiszfeld for the rest.
+
+    The state file records the settings it was computed with and, for each user, the point count and checksum, last
+    continuous median, whether the solver converged, and the median that was written. It is rewritten at the end of
+    the run. Users can come in any order.
+    """
+    settings = incremental_settings(num_iter, max_user_points, seed)
+    previous = UserState(state_fn, settings)
+    count_reused = 0
+    count_warm = 0
+    count_new = 0
+    with open(state_fn + '.tmp', 'w') as fout:
+        statewriter = csv.writer(fout)
+        statewriter.writerow(['settings', json.dumps(settings, sort_keys=True)])
+        statewriter.writerow(STATE_COLUMNS)
+        for current_uid, data_points in users:
+            num_points = len(data_points)
+            digest = point_digest(data_points)
+            state = previous.pop(current_uid)
+            if state and int(state[1]) == num_points and int(state[2]) == digest and state[5] == 'True':
+                count_reused += 1
+                if state[6] or OUTPUT_ALL_USERS:
+                    csvwriter.writerow([current_uid, state[6]])
+                statewriter.writerow(state)
+                continue
+
+            start_median = None
+            if state and state[3]:
+                start_median = (float(state[3]), float(state[4]))
+                count_warm += 1
+            else:
+                count_new += 1
+            info = {}
+            median = user_median(data_points, num_iter, current_uid, start_median, info)
+            write_medians(csvwriter, [current_uid], [median])
+            if median:
+                median = (round(median[0],6), round(median[1],6))
+            solved = info.get('median', ('', ''))
+            statewriter.writerow([current_uid, num_points, digest, solved[0], solved[1], info.get('converged', True),
+                                  median or ''])
+            if (count_reused + count_warm + count_new) % 2500 == 0:
+                print("Processed {0} users.".format(count_reused + count_warm + count_new))
+    previous.close()
+    os.replace(state_fn + '.tmp', state_fn)
+    print("{0} users unchanged, {1} warm-started, and {2} new. {3} users no longer in the input.".format(
+        count_reused, count_warm, count_new, len(previous)))
+
+
+def read_unsorted_user_points(points_fn, memory_mb, tmp_dir=None):
+    """Yield (uid, [(lat, lon), ...]) for every user when rows for a user aren't contiguous in points_fn.
+
+    Rows are hash-partitioned by uid into enough on-disk buckets that each bucket fits in memory_mb, then each bucket is
+    grouped in memory. Users come out bucket by bucket (in first-seen order within a bucket), not in input order.
+    """
+    estimated_mb = os.path.getsize(points_fn) * PARTITION_MEMORY_FACTOR / (1024.0 * 1024.0)
+    num_buckets = max(int(numpy.ceil(estimated_mb / memory_mb)), 1)
+    if num_buckets > MAX_PARTITIONS:
+        print("WARNING: {0} needs {1} buckets to stay within {2:.1f} MB but MAX_PARTITIONS is {3}, so each bucket "
+              "will use about {4:.1f} MB.".format(points_fn, num_buckets, memory_mb, MAX_PARTITIONS,
+                                                 estimated_mb / MAX_PARTITIONS))
+        num_buckets = MAX_PARTITIONS
+    if num_buckets == 1:
+        users = {}
+        with open(points_fn, 'r') as fin:
+            csvreader = csv.reader(fin)
+            assert next(csvreader) == ['uid','lat','lon']
             for line in csvreader:
-                if line[0] == current_uid:
-                    data_points.append((float(line[1]), float(line[2])))
-                else:
-                    count += 1
-                    if count % 2500 == 0:
-                        print("Processed {0} users.".format(count))
-
-                    compute_user_median(data_points, iterations, csvwriter, current_uid)
-
-                    # set user and restart array for new current user
-                    current_uid = line[0]
-                    data_points = [(float(line[1]), float(line[2]))]
-            # compute final user median
+                users.setdefault(line[0], []).append((float(line[1]), float(line[2])))
+        for user in users.items():
+            yield user
+        return
+
+    partition_dir = tempfile.mkdtemp(prefix='geo_median_', dir=tmp_dir)
+    try:
+        bucket_fns = [os.path.join(partition_dir, '{0}.csv'.format(i)) for i in range(0, num_buckets)]
+        bucket_fps = [open(fn, 'w') for fn in bucket_fns]
+        bucket_writers = [csv.writer(fp) for fp in bucket_fps]
+        with open(points_fn, 'r') as fin:
+            csvreader = csv.reader(fin)
+            assert next(csvreader) == ['uid','lat','lon']
+            for line in csvreader:
+                bucket_writers[zlib.crc32(line[0].encode()) % num_buckets].writerow(line)
+        for fp in bucket_fps:
+            fp.close()
+        print("Partitioned {0} into {1} buckets in {2}.".format(points_fn, num_buckets, partition_dir))
+
+        for bucket_fn in bucket_fns:
+            users = {}
+            with open(bucket_fn, 'r') as fin:
+                for line in csv.reader(fin):
+                    users.setdefault(line[0], []).append((float(line[1]), float(line[2])))
+            os.remove(bucket_fn)
+            for user in users.items():
+                yield user
+    finally:
+        shutil.rmtree(partition_dir, ignore_errors=True)
+
+
+def benchmark(num_users, iterations=1000):
+    """Compare users/sec and output of the geopy and vectorized solvers on the first num_users eligible users."""
+    users = []
+    for uid, data_points in read_user_points(DATA_POINTS_FILE):
+        if len(data_points) >= LIMIT_POINTS:
+            users.append((uid, data_points))
+            if len(users) == num_users:
+                break
+
+    geopy_iterations = 0
+    start = time.time()
+    geopy_medians = []
+    for uid, data_points in users:
+        info = {}
+        geopy_medians.append(weiszfeld_median(data_points, iterations, uid, info=info))
+        geopy_iterations += info['iterations']
+    geopy_rate = len(users) / (time.time() - start)
+
+    start = time.time()
+    vectorized_medians = []
+    for uid, data_points in users:
+        points, weights = dedupe_points(data_points)
+        vectorized_medians.append(vectorized_median(points, iterations, uid, weights))
+    vectorized_rate = len(users) / (time.time() - start)
+
+    projected_iterations = 0
+    start = time.time()
+    projected_medians = []
+    for uid, data_points in users:
+        points, weights = dedupe_points(data_points)
+        info = {}
+        projected_medians.append(projected_median(points, iterations, uid, weights, info=info))
+        projected_iterations += info['iterations']
+    projected_rate = len(users) / (time.time() - start)
+
+    start = time.time()
+    batched_medians(users, iterations)
+    batched_rate = len(users) / (time.time() - start)
+
+    differences = [great_circle(geopy_medians[i], vectorized_medians[i]).meters for i in range(0, len(users))]
+    print("geopy solver: {0:.1f} users/sec.".format(geopy_rate))
+    print("vectorized solver: {0:.1f} users/sec ({1:.1f}x).".format(vectorized_rate, vectorized_rate / geopy_rate))
+    print("batched solver: {0:.1f} users/sec ({1:.1f}x).".format(batched_rate, batched_rate / geopy_rate))
+    print("{0} of {1} medians within {2} m; max difference {3:.3f} m.".format(
+        sum(1 for d in differences if d <= DISTANCE_THRESHOLD), len(users), DISTANCE_THRESHOLD, max(differences)))
+    differences = [great_circle(geopy_medians[i], projected_medians[i]).meters for i in range(0, len(users))]
+    print("projected solver: {0:.1f} users/sec ({1:.1f}x).".format(projected_rate, projected_rate / geopy_rate))
+    print("Average iterations per user: {0:.1f} geopy and {1:.1f} projected.".format(
+        float(geopy_iterations) / len(users), float(projected_iterations) / len(users)))
+    print("{0} of {1} projected medians within {2} m; median difference {3:.3f} m and max {4:.3f} m.".format(
+        sum(1 for d in differences if d <= DISTANCE_THRESHOLD), len(users), DISTANCE_THRESHOLD,
+        numpy.median(differences), max(differences)))
+
+    if SNAP_TO_USER_POINTS:
+        start = time.time()
+        geopy_medoids = [geopy_medoid(data_points) for uid, data_points in users]
+        geopy_rate = len(users) / (time.time() - start)
+
+        start = time.time()
+        fast_medoids = []
+        for i in range(0, len(users)):
+            points, weights = dedupe_points(users[i][1])
+            fast_medoids.append(vectorized_medoid(points, weights, vectorized_medians[i]))
+        fast_rate = len(users) / (time.time() - start)
+
+        print("geopy medoid: {0:.1f} users/sec.".format(geopy_rate))
+        print("vectorized medoid ({0} candidates): {1:.1f} users/sec ({2:.1f}x).".format(
+            SNAP_CANDIDATES or 'all', fast_rate, fast_rate / geopy_rate))
+        print("{0} of {1} medoids match the exhaustive geopy search.".format(
+            sum(1 for i in range(0, len(users)) if tuple(geopy_medoids[i]) == fast_medoids[i]), len(users)))
+
+
+def cap_report(num_users, max_points, iterations=1000, seed=None):
+    """Compare capped and uncapped medians for the first num_users users with more than max_points points."""
+    users = []
+    for uid, data_points in read_user_points(DATA_POINTS_FILE):
+        if len(data_points) > max_points:
+            users.append((uid, data_points))
+            if len(users) == num_users:
+                break
+    if not users:
+        print("No users with more than {0} points.".format(max_points))
+        return
+
+    start = time.time()
+    full_medians = [user_median(data_points, iterations, uid) for uid, data_points in users]
+    full_time = time.time() - start
+    start = time.time()
+    capped_medians = [user_median(reservoir_sample(data_points, max_points, uid, seed), iterations, uid)
+                      for uid, data_points in users]
+    capped_time = time.time() - start
+
+    differences = [great_circle(full_medians[i], capped_medians[i]).meters for i in range(0, len(users))
+                   if full_medians[i] and capped_medians[i]]
+    print("{0} users with more than {1} points ({2:.0f} points on average).".format(
+        len(users), max_points, numpy.mean([len(data_points) for uid, data_points in users])))
+    print("Uncapped: {0:.3f} sec. Capped: {1:.3f} sec ({2:.1f}x).".format(
+        full_time, capped_time, full_time / capped_time if capped_time else float('inf')))
+    print("{0} of {1} users pass the MAD filter uncapped and {2} capped; {3} disagree.".format(
+        sum(1 for m in full_medians if m), len(users), sum(1 for m in capped_medians if m),
+        sum(1 for i in range(0, len(users)) if bool(full_medians[i]) != bool(capped_medians[i]))))
+    if differences:
+        print("Capped median distance from uncapped: median {0:.1f} m, 95th percentile {1:.1f} m, "
+              "max {2:.1f} m.".format(numpy.median(differences), numpy.percentile(differences, 95), max(differences)))
+
+
+def main(iterations=1000):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--solver', default=SOLVER, choices=['vincenty', 'vectorized', 'projected'],
+                        help="Per-user solver (the --batch_users engine always uses vectorized Vincenty distances)")
+    parser.add_argument('--benchmark', type=int, default=0,
+                        help="Time both solvers on this many users from the input instead of writing medians")
+    parser.add_argument('--batch_users', type=int, default=0,
+                        help="Solve this many users at a time with the batched engine (0 = one user at a time)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes (each gets --batch_users or --chunk_users users at a time)")
+    parser.add_argument('--chunk_users', type=int, default=1000)
+    parser.add_argument('--no_dedupe', action='store_true',
+                        help="Don't collapse repeated coordinates into weighted points in the vectorized/batched "
+                             "solvers")
+    parser.add_argument('--snap_to_user_points', action='store_true', default=SNAP_TO_USER_POINTS,
+                        help="Snap each median to the user's most central point (medoid)")
+    parser.add_argument('--snap_candidates', type=int, default=SNAP_CANDIDATES,
+                        help="Points nearest the continuous median considered when snapping (0 = all points)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only recompute users whose points changed since the last --incremental run")
+    parser.add_argument('--state_fn', default=USER_STATE_FILE)
+    parser.add_argument('--unsorted', action='store_true',
+                        help="Input rows aren't grouped by uid: hash-partition them to disk first instead of sorting")
+    parser.add_argument('--memory_mb', type=float, default=2048, help="Memory budget for one partition with --unsorted")
+    parser.add_argument('--tmp_dir', default=None, help="Where partitions are spilled with --unsorted")
+    parser.add_argument('--max_user_points', type=int, default=MAX_USER_POINTS,
+                        help="Keep a seeded reservoir sample of at most this many points per user (0 = all points)")
+    parser.add_argument('--reservoir_seed', type=int, default=RESERVOIR_SEED)
+    parser.add_argument('--cap_report', type=int, default=0,
+                        help="Compare capped and uncapped medians on this many users above --max_user_points and exit")
+    args = parser.parse_args()
+    set_options({'SOLVER': args.solver, 'DEDUPLICATE_POINTS': not args.no_dedupe,
+                 'SNAP_TO_USER_POINTS': args.snap_to_user_points, 'SNAP_CANDIDATES': args.snap_candidates})
+    if args.benchmark:
+        benchmark(args.benchmark, iterations)
+        return
+    if args.cap_report:
+        if args.max_user_points <= 0:
+            parser.error("--cap_report needs --max_user_points")
+        cap_report(args.cap_report, args.max_user_points, iterations, args.reservoir_seed)
+        return
+    if args.incremental and (args.workers > 1 or args.batch_users):
+        parser.error("--incremental solves changed users one at a time and can't be combined with "
+                     "--workers/--batch_users")
+
+    if args.unsorted:
+        users = read_unsorted_user_points(DATA_POINTS_FILE, args.memory_mb, args.tmp_dir)
+    else:
+        users = read_user_points(DATA_POINTS_FILE)
+    if args.max_user_points > 0:
+        users = cap_user_points(users, args.max_user_points, args.reservoir_seed)
+
+    count = 0
+    with open(OUTPUT_MEDIANS, 'w') as fout:
+        csvwriter = csv.writer(fout)
+        csvwriter.writerow(['uid','median'])
+        if args.incremental:
+            incremental_medians(csvwriter, users, iterations, args.state_fn, args.max_user_points,
+                                args.reservoir_seed)
+            return
+        if args.workers > 1:
+            parallel_medians(csvwriter, users, iterations, args.workers,
+                             args.batch_users or args.chunk_users, bool(args.batch_users))
+            return
+        if args.batch_users:
+            for chunk in chunk_users(users, args.batch_users):
+                write_medians(csvwriter, [user[0] for user in chunk], batched_medians(chunk, iterations))
+                count += len(chunk)
+                print("Processed {0} users.".format(count))
+            return
+        for current_uid, data_points in users:
             compute_user_median(data_points, iterations, csvwriter, current_uid)
+            count += 1
+            if count % 2500 == 0:
+                print("Processed {0} users.".format(count))
 
 
 if __name__ == "__main__":
@@ -1,7 +1,8 @@
 import csv
-import json
+import sys
 
-from shapely.geometry import shape
+sys.path.append("./utils")
+from county_index import load_county_index
 
 # Download from: http://download.geonames.org/export/dump/
 ADMIN1_FN = "resources/admin1CodesASCII.txt"
@@ -9,7 +10,6 @@ CITIES_FN = "resources/allCountries.txt"
 COUNTRIES_FN = "resources/country_codes.tsv"  # from: http://download.geonames.org/export/dump/countryInfo.txt
 
 GEONAMES_PARSED_FN = "resources/geonames_countries.tsv"
-COUNTIES_GEOJSON = "resources/USCounties_bare.geojson"
 COUNT_AMBIGUOUS = 0
 DELIMITER=','
 
@@ -117,27 +117,25 @@ def main():
     length_without_admin2 = len(geonames)
 
     county_counts = {}
-    with open(COUNTIES_GEOJSON, 'r') as fin:
-        counties = json.load(fin)
-
-        for county in counties['features']:
-            try:
-                county['centroid'] = shape(county['geometry']).centroid
-                state = county['properties']['StateName']
-                county_name = county['properties']['CountyName']
-                county_state = county_name + DELIMITER + state
-                geonames[county_state] = (county['centroid'].y, county['centroid'].x)
-                if county_name in county_counts:
-                    county_counts[county_name]['count'] += 1
-                else:
-                    county_counts[county_name] = {'count':1, 'lat_lon': (county['centroid'].y, county['centroid'].x)}
-            except Exception as e:
-                print(e)
-                print(line)
-        for county in county_counts:
-            if county_counts[county]['count'] == 1:
-                if county not in geonames:
-                    geonames[county] = county_counts[county]['lat_lon']
+    county_index = load_county_index()
+    for i in range(0, len(county_index)):
+        try:
+            centroid = county_index.geometries[i].centroid
+            state = county_index.state_names[i]
+            county_name = county_index.county_names[i]
+            county_state = county_name + DELIMITER + state
+            geonames[county_state] = (centroid.y, centroid.x)
+            if county_name in county_counts:
+                county_counts[county_name]['count'] += 1
+            else:
+                county_counts[county_name] = {'count':1, 'lat_lon': (centroid.y, centroid.x)}
+        except Exception as e:
+            print(e)
+            print(county_index.fips[i])
+    for county in county_counts:
+        if county_counts[county]['count'] == 1:
+            if county not in geonames:
+                geonames[county] = county_counts[county]['lat_lon']
 
     print("{0} counties added.".format(len(geonames) - length_without_admin2))
 
@@ -0,0 +1,71 @@
+"""One-time compile of the county GeoJSON into memory-mappable arrays plus the precomputed county grid.
+
+Run from the rq1and3_localness directory: python utils/compile_counties.py
+Later runs of localness.py, point_to_county.py, count_local_vgi.py, and prep_geonames.py load the artifact instead of
+parsing GeoJSON, and worker processes share the mapped pages.
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy
+import shapely
+
+from county_index import COMPILED_DIR
+from county_index import COUNTIES_FN
+from county_index import COMPILED_SOURCE_FN
+from county_index import CountyIndex
+from county_index import load_county_index
+from county_index import source_stamp
+from county_grid import CountyGrid
+from county_grid import load_county_grid
+
+
+def compile_counties(counties_fn=COUNTIES_FN, compiled_dir=COMPILED_DIR):
+    """Write FIPS/name/bounds arrays, concatenated WKB blobs with offsets, and the county grid to compiled_dir."""
+    if not os.path.exists(compiled_dir):
+        os.makedirs(compiled_dir)
+    if os.path.exists(os.path.join(compiled_dir, COMPILED_SOURCE_FN)):
+        os.remove(os.path.join(compiled_dir, COMPILED_SOURCE_FN))
+
+    county_index = CountyIndex.from_geojson(counties_fn)
+    wkb = shapely.to_wkb(county_index.geometries)
+    offsets = numpy.zeros(len(wkb) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum([len(blob) for blob in wkb])
+
+    arrays = {'fips': numpy.array(county_index.fips),
+              'county_names': numpy.array(county_index.county_names),
+              'state_names': numpy.array(county_index.state_names),
+              'bounds': shapely.bounds(county_index.geometries),
+              'wkb': numpy.frombuffer(b''.join(wkb), dtype=numpy.uint8),
+              'wkb_offsets': offsets}
+    for name in arrays:
+        numpy.save(os.path.join(compiled_dir, name + '.npy'), arrays[name])
+
+    CountyGrid(county_index).save(compiled_dir)
+    with open(os.path.join(compiled_dir, COMPILED_SOURCE_FN), 'w') as fout:  # written last: marks the artifact complete
+        json.dump(source_stamp(counties_fn), fout)
+    print("{0} counties compiled to {1}.".format(len(county_index), compiled_dir))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--counties_fn', default=COUNTIES_FN)
+    parser.add_argument('--compiled_dir', default=COMPILED_DIR)
+    args = parser.parse_args()
+
+    start = time.time()
+    CountyIndex.from_geojson(args.counties_fn)
+    print("Startup from GeoJSON: {0:.3f} seconds.".format(time.time() - start))
+
+    compile_counties(args.counties_fn, args.compiled_dir)
+
+    start = time.time()
+    load_county_grid(load_county_index(args.compiled_dir, args.counties_fn), args.compiled_dir)
+    print("Startup from compiled counties (index + grid): {0:.3f} seconds.".format(time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
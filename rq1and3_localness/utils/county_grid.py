@@ -0,0 +1,193 @@
+"""Precomputed quadtree over the contiguous US so that only points near county boundaries need an exact polygon test."""
+
+import os
+
+import numpy
+from shapely.geometry import Point
+from shapely.geometry import box
+
+from county_index import COMPILED_DIR
+from county_index import load_compiled_arrays
+
+# Contiguous US bounding box (covers every polygon in USCounties_bare.geojson)
+US_BOUNDS = (-124.848974, 24.396308, -66.885444, 49.384358)
+
+# node kinds - the meaning of node_value depends on the kind
+OUTSIDE = 0  # outside all counties (value unused)
+INSIDE = 1  # entirely inside one county (value = county index)
+BOUNDARY = 2  # straddles a boundary (value = offset into -1 terminated candidates array)
+SPLIT = 3  # split into quadrants (value = node of the SW child, followed by SE, NW, NE)
+
+GRID_ARRAYS = ['grid_cells', 'grid_node_kind', 'grid_node_value', 'grid_candidates', 'grid_params']
+
+
+class CountyGrid(object):
+    """Hierarchical grid of cells that are either inside one county, outside all counties, or on a boundary.
+
+    Top-level cells are cell_size degrees on a side. Boundary cells are split into quadrants up to max_depth times.
+    The tree is stored in flat arrays so it can be saved with the compiled counties and memory-mapped.
+    Exposes the same lookup methods as CountyIndex.
+    """
+
+    def __init__(self, county_index, cell_size=0.5, max_depth=4, bounds=US_BOUNDS, arrays=None):
+        self.county_index = county_index
+        self.fips = county_index.fips
+        self.source = county_index.source
+        self.cell_size = cell_size
+        self.max_depth = max_depth
+        self.west, self.south, self.east, self.north = bounds
+        self.num_cols = int(numpy.ceil((self.east - self.west) / cell_size))
+        self.num_rows = int(numpy.ceil((self.north - self.south) / cell_size))
+        self.count_lookups = 0
+        self.count_exact = 0
+
+        if arrays is None:
+            arrays = self.build()
+        self.cells, self.node_kind, self.node_value, self.candidates = arrays
+
+    def __len__(self):
+        return len(self.fips)
+
+    def build(self):
+        """Classify every top-level cell, recursing into boundary cells."""
+        kinds = []
+        values = []
+        candidates = []
+        cells = numpy.empty((self.num_rows, self.num_cols), dtype=numpy.int32)
+        for row in range(0, self.num_rows):
+            for col in range(0, self.num_cols):
+                node = len(kinds)
+                cells[row, col] = node
+                kinds.append(OUTSIDE)
+                values.append(0)
+                self.fill_node(node, self.west + col * self.cell_size, self.south + row * self.cell_size,
+                               self.cell_size, 0, kinds, values, candidates)
+        return (cells, numpy.array(kinds, dtype=numpy.int8), numpy.array(values, dtype=numpy.int32),
+                numpy.array(candidates, dtype=numpy.int32))
+
+    def fill_node(self, node, x0, y0, size, depth, kinds, values, candidates):
+        cell = box(x0, y0, x0 + size, y0 + size)
+        county_idx = [i for i in sorted(self.county_index.tree.query(cell))
+                      if self.county_index.prepared[i].intersects(cell)]
+        if not county_idx:
+            kinds[node] = OUTSIDE
+        elif len(county_idx) == 1 and self.county_index.prepared[county_idx[0]].contains_properly(cell):
+            kinds[node] = INSIDE
+            values[node] = county_idx[0]
+        elif depth == self.max_depth:
+            kinds[node] = BOUNDARY
+            values[node] = len(candidates)
+            candidates.extend(county_idx)
+            candidates.append(-1)
+        else:
+            # reserve four consecutive nodes for the children before filling them
+            first_child = len(kinds)
+            kinds.extend([OUTSIDE] * 4)
+            values.extend([0] * 4)
+            kinds[node] = SPLIT
+            values[node] = first_child
+            half = size / 2.0
+            self.fill_node(first_child, x0, y0, half, depth + 1, kinds, values, candidates)
+            self.fill_node(first_child + 1, x0 + half, y0, half, depth + 1, kinds, values, candidates)
+            self.fill_node(first_child + 2, x0, y0 + half, half, depth + 1, kinds, values, candidates)
+            self.fill_node(first_child + 3, x0 + half, y0 + half, half, depth + 1, kinds, values, candidates)
+
+    def find_leaf(self, lat, lon):
+        """Return the leaf node containing (lat, lon), or -1 if beyond the grid."""
+        col = (lon - self.west) // self.cell_size
+        row = (lat - self.south) // self.cell_size
+        if not (0 <= col < self.num_cols and 0 <= row < self.num_rows):  # also catches NaN
+            return -1
+        col = int(col)
+        row = int(row)
+        node = self.cells[row, col]
+        x0 = self.west + col * self.cell_size
+        y0 = self.south + row * self.cell_size
+        size = self.cell_size
+        while self.node_kind[node] == SPLIT:
+            size /= 2.0
+            east = lon >= x0 + size
+            north = lat >= y0 + size
+            if east:
+                x0 += size
+            if north:
+                y0 += size
+            node = self.node_value[node] + 2 * north + east
+        return node
+
+    def lookup(self, lat, lon):
+        """Return the FIPS code of the county containing (lat, lon) or None if outside all counties."""
+        self.count_lookups += 1
+        node = self.find_leaf(lat, lon)
+        if node < 0 or self.node_kind[node] == OUTSIDE:
+            return None
+        if self.node_kind[node] == INSIDE:
+            return self.fips[self.node_value[node]]
+        self.count_exact += 1
+        pt = Point(lon, lat)
+        i = self.node_value[node]
+        while self.candidates[i] >= 0:
+            if self.county_index.prepared[self.candidates[i]].contains(pt):
+                return self.fips[self.candidates[i]]
+            i += 1
+        return None
+
+    def lookup_point(self, pt):
+        return self.lookup(pt.y, pt.x)
+
+    def lookup_many(self, lats, lons):
+        """Descend the grid for all points at once and send only boundary points to the exact batch lookup."""
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+        with numpy.errstate(invalid='ignore'):
+            cols = numpy.floor((lons - self.west) / self.cell_size)
+            rows = numpy.floor((lats - self.south) / self.cell_size)
+            in_grid = (cols >= 0) & (rows >= 0) & (cols < self.num_cols) & (rows < self.num_rows)
+        cols = numpy.where(in_grid, cols, 0).astype(numpy.int64)
+        rows = numpy.where(in_grid, rows, 0).astype(numpy.int64)
+        nodes = numpy.where(in_grid, self.cells[rows, cols], -1)
+        x0 = self.west + cols * self.cell_size
+        y0 = self.south + rows * self.cell_size
+        size = numpy.full(len(lats), self.cell_size)
+        for depth in range(0, self.max_depth):
+            split = in_grid & (self.node_kind[numpy.maximum(nodes, 0)] == SPLIT)
+            if not split.any():
+                break
+            size = numpy.where(split, size / 2.0, size)
+            east = split & (lons >= x0 + size)
+            north = split & (lats >= y0 + size)
+            x0 = numpy.where(east, x0 + size, x0)
+            y0 = numpy.where(north, y0 + size, y0)
+            nodes = numpy.where(split, self.node_value[numpy.maximum(nodes, 0)] + 2 * north + east, nodes)
+
+        kinds = numpy.where(in_grid, self.node_kind[numpy.maximum(nodes, 0)], OUTSIDE)
+        values = self.node_value[numpy.maximum(nodes, 0)]
+        results = [self.fips[values[i]] if kinds[i] == INSIDE else None for i in range(0, len(lats))]
+        boundary = numpy.nonzero(kinds == BOUNDARY)[0]
+        self.count_lookups += len(lats)
+        self.count_exact += len(boundary)
+        if len(boundary):
+            boundary_results = self.county_index.lookup_many(lats[boundary], lons[boundary])
+            for i in range(0, len(boundary)):
+                results[boundary[i]] = boundary_results[i]
+        return results
+
+    def save(self, compiled_dir):
+        """Write the flat grid arrays next to the compiled county geometries."""
+        params = numpy.array([self.cell_size, self.max_depth, self.west, self.south, self.east, self.north])
+        for name, array in zip(GRID_ARRAYS, [self.cells, self.node_kind, self.node_value, self.candidates, params]):
+            numpy.save(os.path.join(compiled_dir, name + '.npy'), array)
+
+    def print_stats(self):
+        print("{0} of {1} grid lookups needed an exact polygon test.".format(self.count_exact, self.count_lookups))
+
+
+def load_county_grid(county_index, compiled_dir=COMPILED_DIR):
+    """Memory-map the grid from the compiled artifact if the county index came from it too, otherwise build it."""
+    if county_index.compiled_dir != compiled_dir or not os.path.exists(os.path.join(compiled_dir, 'grid_params.npy')):
+        return CountyGrid(county_index)
+    arrays = load_compiled_arrays(compiled_dir, GRID_ARRAYS)
+    cell_size, max_depth, west, south, east, north = arrays['grid_params'].tolist()
+    return CountyGrid(county_index, cell_size, int(max_depth), (west, south, east, north),
+                      arrays=(arrays['grid_cells'], arrays['grid_node_kind'], arrays['grid_node_value'],
+                              arrays['grid_candidates']))
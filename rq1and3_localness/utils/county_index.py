@@ -0,0 +1,192 @@
+"""Spatial index over the US county polygons for point-in-county lookups."""
+
+import json
+import os
+import random
+import time
+
+import numpy
+import shapely
+from shapely.geometry import Point
+from shapely.geometry import shape
+from shapely.geometry import box
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+COUNTIES_FN = 'resources/USCounties_bare.geojson'
+STATES_FN = 'resources/US_States_from_counties.geojson'
+# output of utils/compile_counties.py - used instead of the GeoJSON when present and compiled from its current version
+COMPILED_DIR = 'resources/compiled_counties'
+COMPILED_SOURCE_FN = 'source.json'  # size and mtime of the GeoJSON the artifact was compiled from
+
+
+class CountyIndex(object):
+    """STRtree of prepared county geometries so a lookup only tests the counties whose bounds contain the point."""
+
+    def __init__(self, fips, geometries, county_names=None, state_names=None, compiled_dir=None, source=None):
+        self.fips = list(fips)
+        self.geometries = list(geometries)
+        self.county_names = county_names
+        self.state_names = state_names
+        self.prepared = [prep(geom) for geom in self.geometries]
+        self.tree = STRtree(self.geometries)
+        self.compiled_dir = compiled_dir  # set when loaded from a compiled artifact, whose grid can then be used too
+        self.source = source  # source_stamp() of the GeoJSON the counties came from
+
+    @classmethod
+    def from_geojson(cls, counties_fn=COUNTIES_FN):
+        """Build the index by parsing the county GeoJSON."""
+        with open(counties_fn, 'r') as fin:
+            counties_gj = json.load(fin)
+
+        fips = []
+        geometries = []
+        county_names = []
+        state_names = []
+        for region in counties_gj['features']:
+            fips.append(region['properties']['FIPS'])
+            county_names.append(region['properties']['CountyName'])
+            state_names.append(region['properties']['StateName'])
+            geometries.append(shape(region['geometry']))
+        return cls(fips, geometries, county_names, state_names, source=source_stamp(counties_fn))
+
+    @classmethod
+    def from_compiled(cls, compiled_dir=COMPILED_DIR):
+        """Build the index from the memory-mapped arrays written by compile_counties.py."""
+        arrays = load_compiled_arrays(compiled_dir, ['fips', 'county_names', 'state_names', 'wkb', 'wkb_offsets'])
+        wkb = arrays['wkb']
+        offsets = arrays['wkb_offsets']
+        geometries = shapely.from_wkb([wkb[offsets[i]:offsets[i + 1]].tobytes() for i in range(0, len(offsets) - 1)])
+        with open(os.path.join(compiled_dir, COMPILED_SOURCE_FN), 'r') as fin:
+            source = json.load(fin)
+        return cls(arrays['fips'].tolist(), geometries, arrays['county_names'].tolist(), arrays['state_names'].tolist(),
+                   compiled_dir, source)
+
+    def __len__(self):
+        return len(self.fips)
+
+    def lookup_point(self, pt):
+        """Return the FIPS code of the county containing the Shapely point or None if outside all counties."""
+        # candidates come back in GeoJSON feature order, so ties resolve the same way on every run
+        for i in sorted(self.tree.query(pt)):
+            if self.prepared[i].contains(pt):
+                return self.fips[i]
+        return None
+
+    def lookup(self, lat, lon):
+        """Return the FIPS code of the county containing (lat, lon) or None if outside all counties."""
+        return self.lookup_point(Point(lon, lat))
+
+    def lookup_many(self, lats, lons):
+        """Return a list of FIPS codes (or None) for arrays of lat/lon using one vectorized STRtree query.
+
+        NaN coordinates (e.g., unparseable rows) are never matched.
+        """
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+        county_idx = numpy.full(len(lats), -1, dtype=numpy.int64)
+        valid = ~(numpy.isnan(lats) | numpy.isnan(lons))
+        valid_idx = numpy.nonzero(valid)[0]
+        if len(valid_idx):
+            points = shapely.points(lons[valid_idx], lats[valid_idx])
+            pt_idx, geom_idx = self.tree.query(points, predicate='within')
+            # keep the first county in GeoJSON feature order for each point to match lookup_point
+            order = numpy.lexsort((geom_idx, pt_idx))
+            pt_idx = pt_idx[order]
+            geom_idx = geom_idx[order]
+            first_pt_idx, first = numpy.unique(pt_idx, return_index=True)
+            county_idx[valid_idx[first_pt_idx]] = geom_idx[first]
+        return [self.fips[i] if i >= 0 else None for i in county_idx]
+
+
+def load_compiled_arrays(compiled_dir, names):
+    """Memory-map the named .npy arrays from a compiled counties directory."""
+    return {name: numpy.load(os.path.join(compiled_dir, name + '.npy'), mmap_mode='r') for name in names}
+
+
+def source_stamp(counties_fn):
+    """Size and modification time of the county GeoJSON, recorded in the artifact compiled from it."""
+    stat = os.stat(counties_fn)
+    return {'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+
+def compiled_is_current(compiled_dir, counties_fn):
+    """Whether compiled_dir has an artifact compiled from the current version of counties_fn."""
+    source_fn = os.path.join(compiled_dir, COMPILED_SOURCE_FN)
+    if not os.path.exists(source_fn) or not os.path.exists(counties_fn):
+        return False
+    with open(source_fn, 'r') as fin:
+        return json.load(fin) == source_stamp(counties_fn)
+
+
+def load_county_index(compiled_dir=COMPILED_DIR, counties_fn=COUNTIES_FN):
+    """Load the county index from the compiled artifact if it is up to date, otherwise from the GeoJSON."""
+    if os.path.exists(os.path.join(compiled_dir, 'fips.npy')):
+        if compiled_is_current(compiled_dir, counties_fn):
+            return CountyIndex.from_compiled(compiled_dir)
+        print("WARNING: compiled counties in {0} don't match {1} - parsing it instead. Rerun utils/compile_counties.py "
+              "to update them.".format(compiled_dir, counties_fn))
+    else:
+        print("No compiled counties in {0} - parsing {1}. Run utils/compile_counties.py to speed up startup.".format(
+            compiled_dir, counties_fn))
+    return CountyIndex.from_geojson(counties_fn)
+
+
+def build_state_bbox_counties(counties_fn=COUNTIES_FN, states_fn=STATES_FN):
+    """Build the original state bounding box -> counties structure (kept for benchmarking against)."""
+    with open(counties_fn, 'r') as fin:
+        counties_gj = json.load(fin)
+
+    with open(states_fn, 'r') as fin:
+        states_gj = json.load(fin)
+
+    counties = {}
+    for state in states_gj['features']:
+        west, south, east, north = shape(state['geometry']).bounds
+        counties[state['properties']['FIPS'][:2]] = {'bb':box(west, south, east, north), 'counties':{}}
+    for region in counties_gj['features']:
+        state_fips = region['properties']['FIPS'][:2]
+        counties[state_fips]['counties'][region['properties']['FIPS']] = shape(region['geometry'])
+    return counties
+
+
+def state_bbox_lookup(counties, pt):
+    """Linear scan over state bounding boxes and then unprepared county polygons."""
+    for state in counties:
+        if counties[state]['bb'].contains(pt):
+            for fips in counties[state]['counties']:
+                if counties[state]['counties'][fips].contains(pt):
+                    return fips
+    return None
+
+
+def benchmark(num_points=20000, seed=2016):
+    """Print lookups/sec for the state bounding box scan vs. the STRtree index on random points in the contiguous US."""
+    rng = random.Random(seed)
+    points = [Point(rng.uniform(-124.848974, -66.885444), rng.uniform(24.396308, 49.384358)) for i in range(0, num_points)]
+
+    counties = build_state_bbox_counties()
+    start = time.time()
+    bbox_results = [state_bbox_lookup(counties, pt) for pt in points]
+    bbox_rate = num_points / (time.time() - start)
+
+    county_index = load_county_index()
+    start = time.time()
+    index_results = [county_index.lookup_point(pt) for pt in points]
+    index_rate = num_points / (time.time() - start)
+
+    lats = numpy.array([pt.y for pt in points])
+    lons = numpy.array([pt.x for pt in points])
+    start = time.time()
+    batch_results = county_index.lookup_many(lats, lons)
+    batch_rate = num_points / (time.time() - start)
+
+    mismatches = sum(1 for i in range(0, num_points) if bbox_results[i] != index_results[i] or bbox_results[i] != batch_results[i])
+    print("State bbox scan: {0:.0f} lookups/sec.".format(bbox_rate))
+    print("STRtree index: {0:.0f} lookups/sec ({1:.1f}x).".format(index_rate, index_rate / bbox_rate))
+    print("STRtree batch: {0:.0f} lookups/sec ({1:.1f}x).".format(batch_rate, batch_rate / bbox_rate))
+    print("{0} of {1} lookups disagree.".format(mismatches, num_points))
+
+
+if __name__ == "__main__":
+    benchmark()
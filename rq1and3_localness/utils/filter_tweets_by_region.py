@@ -1,13 +1,18 @@
 """Split tweets file up by geography (e.g., one file for all tweets in Pennsylvania, one for Ohio, etc.)"""
 
 import csv
-import json
 import traceback
 
+from tweet_fields import TweetParser
+from tweet_fields import TEXT_FIELDS
+from tweet_columns import iter_rows
+
 REGION = "counties"
 INPUT_FN = "<PATH NAME TO TWITTER LOCALNESS OUTPUT CSV>"
 INPUT_HEADER = ['tweet', 'gender', 'race', 'county', 'nday', 'plurality', 'geomed', 'locfield']
 OUTPUT_BASE_PATH = "<PATH TO FOLDER THAT WILL CONTAIN PARSED TWEET FILES>"
+JSON_BACKEND = 'auto'  # see tweet_fields.py
+INPUT_COLUMNS_DIR = None  # localness.py INPUT_COLUMNS_DIR store - read instead of INPUT_FN when set
 
 def process_line(output_line, open_fps, state_files, region, fps):
     if region in open_fps:
@@ -43,37 +48,57 @@ def process_line(output_line, open_fps, state_files, region, fps):
         return 0
 
 
+def read_localness_csv(parser):
+    """Yield (region, [text, uid, nday, plurality]) for each line of INPUT_FN, or None if the tweet can't be read."""
+    with open(INPUT_FN, 'r') as fin:
+        csvreader = csv.reader(fin)
+        assert next(csvreader) == INPUT_HEADER
+        geog_idx = INPUT_HEADER.index('county')
+        tweet_idx = INPUT_HEADER.index('tweet')
+        nday_idx = INPUT_HEADER.index('nday')
+        plur_idx = INPUT_HEADER.index('plurality')
+        for line in csvreader:
+            try:
+                tweet = parser.parse(line[tweet_idx])
+                output = (line[geog_idx], [tweet['text'], tweet['user']['id'], line[nday_idx], line[plur_idx]])
+            except Exception:
+                output = None
+            yield output
+
+
+def read_localness_columns():
+    """Yield the same from INPUT_COLUMNS_DIR, reading only the text, uid, county, nday, and plurality columns."""
+    columns = ['processed', 'county', 'text', 'uid', 'nday', 'plurality']
+    for processed, region, txt, uid, n, p in iter_rows(INPUT_COLUMNS_DIR, columns):
+        if not processed:  # tweets localness.py failed on aren't in its CSV output either
+            continue
+        if txt is None:  # read_localness_csv can't read a tweet without text either
+            yield None
+        else:
+            yield region, [txt, uid, n, p]
+
+
 def main():
     region_files = {}
     fps = []
     open_fps = {}
     line_no = 0
     copied_over = 0
+    parser = TweetParser(TEXT_FIELDS, JSON_BACKEND)
     try:
-        with open(INPUT_FN, 'r') as fin:
-            csvreader = csv.reader(fin)
-            assert next(csvreader) == INPUT_HEADER
-            geog_idx = INPUT_HEADER.index('county')
-            tweet_idx = INPUT_HEADER.index('tweet')
-            nday_idx = INPUT_HEADER.index('nday')
-            plur_idx = INPUT_HEADER.index('plurality')
-            for line in csvreader:
-                line_no += 1
-                try:
-                    region = [line[geog_idx]]
-                    tweet = json.loads(line[tweet_idx])
-                    txt = tweet['text']
-                    uid = line['user']['id']
-                    n = line[nday_idx]
-                    p = line[plur_idx]
-                    output_line = [txt, uid, n, p]
+        lines = read_localness_columns() if INPUT_COLUMNS_DIR else read_localness_csv(parser)
+        for line in lines:
+            line_no += 1
+            try:
+                if line:
+                    region, output_line = line
                     success = process_line(output_line, open_fps, region_files, region, fps)
                     copied_over += success
-                except Exception:
-                    continue
-                finally:
-                    if line_no % 100000 == 0:
-                        print("{0} lines processed and {1} copied over for {2} counties.".format(line_no, copied_over, len(open_fps)))
+            except Exception:
+                continue
+            finally:
+                if line_no % 100000 == 0:
+                    print("{0} lines processed and {1} copied over for {2} counties.".format(line_no, copied_over, len(open_fps)))
     except Exception:
         traceback.print_exc()
         for fp in fps:
@@ -0,0 +1,143 @@
+"""Stream n-day rows (or per-user summaries computed in SQL) out of PostgreSQL or a local SQLite stand-in."""
+
+import datetime
+import threading
+from queue import Queue
+
+ITERSIZE = 100000  # rows fetched per round trip
+CURSOR_NAME = 'nday_stream'
+# SQL that differs between backends - SQLite stores ntime as seconds because it has no interval type
+DIALECTS = {'postgres': {'ntime_seconds': 'EXTRACT(EPOCH FROM ntime)', 'join_fips': "string_agg(({0})::text, ';')"},
+            'sqlite': {'ntime_seconds': 'ntime', 'join_fips': "group_concat({0}, ';')"}}
+SUMMARY_QUERY = """SELECT uid, max(plurality_count), {join_all}, {join_plurality}, {join_local}
+FROM (SELECT uid, fips, count, {ntime_seconds} AS ntime_seconds, max(count) OVER (PARTITION BY uid) AS plurality_count
+      FROM {table_name}) AS regions
+GROUP BY uid;"""
+
+
+def connect(backend, db_name):
+    """Open a connection to the n-day database: a PostgreSQL database name or a SQLite file path."""
+    if backend == 'postgres':
+        import psycopg2
+        return psycopg2.connect("dbname={0}".format(db_name))
+    elif backend == 'sqlite':
+        import sqlite3
+        return sqlite3.connect(db_name)
+    raise ValueError("Unknown database backend: {0}".format(backend))
+
+
+def get_dialect(conn):
+    return 'postgres' if type(conn).__module__.startswith('psycopg2') else 'sqlite'
+
+
+def fetch_batches(cur, itersize):
+    while True:
+        rows = cur.fetchmany(itersize)
+        if not rows:
+            break
+        yield rows
+
+
+def prefetch_batches(batches, depth=2):
+    """Pull batches on a background thread so the next fetch overlaps with processing the current one.
+
+    psycopg2 releases the GIL while it waits on the server, so the transfer runs alongside the Python loop.
+    """
+    queue = Queue(maxsize=depth)
+    done = object()
+
+    def producer():
+        try:
+            for batch in batches:
+                queue.put(batch)
+        except Exception as e:
+            queue.put(e)
+            return
+        queue.put(done)
+
+    thread = threading.Thread(target=producer)
+    thread.daemon = True
+    thread.start()
+    while True:
+        batch = queue.get()
+        if batch is done:
+            break
+        if isinstance(batch, Exception):
+            raise batch
+        yield batch
+    thread.join()
+
+
+def stream_query(conn, query, itersize=ITERSIZE, prefetch=True, name=CURSOR_NAME):
+    """Yield the rows of query itersize at a time.
+
+    psycopg2 connections get a named (server-side) cursor so only one batch is held in client memory, and with
+    prefetch the next batch is fetched while the current one is processed. Other DB-API connections (e.g., sqlite3 as
+    a local stand-in, whose objects can't cross threads) use fetchmany on a regular cursor.
+    """
+    server_side = type(conn).__module__.startswith('psycopg2')
+    if server_side:
+        cur = conn.cursor(name=name)
+        cur.itersize = itersize
+    else:
+        cur = conn.cursor()
+    try:
+        cur.execute(query)
+        batches = fetch_batches(cur, itersize)
+        if prefetch and server_side:
+            batches = prefetch_batches(batches)
+        for batch in batches:
+            for row in batch:
+                yield row
+    finally:
+        cur.close()
+
+
+def as_interval(ntime):
+    """Return ntime as a timedelta (psycopg2 already converts intervals; SQLite stores seconds)."""
+    if isinstance(ntime, datetime.timedelta):
+        return ntime
+    return datetime.timedelta(seconds=ntime)
+
+
+def stream_nday_rows(conn, table_name, itersize=ITERSIZE, prefetch=True):
+    """Yield (uid, fips, count, ntime) rows from an nday table with ntime as a timedelta."""
+    query = "SELECT uid, fips, count, ntime FROM {0};".format(table_name)
+    for uid, fips, count, ntime in stream_query(conn, query, itersize, prefetch):
+        yield uid, fips, count, as_interval(ntime)
+
+
+def summary_query(table_name, nday_min, dialect):
+    """SQL that collapses an nday table to one row per user: plurality count and ';'-joined lists of all counties,
+    plurality counties (most VGI, ties included), and n-day local counties (at least nday_min days of VGI)."""
+    sql = DIALECTS[dialect]
+    return SUMMARY_QUERY.format(
+        table_name=table_name, ntime_seconds=sql['ntime_seconds'],
+        join_all=sql['join_fips'].format('fips'),
+        join_plurality=sql['join_fips'].format('CASE WHEN count = plurality_count THEN fips END'),
+        join_local=sql['join_fips'].format('CASE WHEN ntime_seconds >= {0} THEN fips END'.format(nday_min * 86400)))
+
+
+def split_fips(joined):
+    return joined.split(';') if joined else []
+
+
+def stream_user_summaries(conn, table_name, nday_min, itersize=ITERSIZE, prefetch=True):
+    """Yield (uid, plurality_count, all counties, plurality counties, local counties) with the aggregation done in SQL.
+
+    Counties with a NULL FIPS code count toward the plurality count but are left out of the lists.
+    """
+    query = summary_query(table_name, nday_min, get_dialect(conn))
+    for uid, plurality_count, regions, plurality, local in stream_query(conn, query, itersize, prefetch):
+        yield uid, plurality_count, split_fips(regions), split_fips(plurality), split_fips(local)
+
+
+def write_sqlite(db_fn, table_name, rows):
+    """Load (uid, fips, count, ntime) rows into a SQLite nday table (ntime in seconds) for local testing."""
+    import sqlite3
+    conn = sqlite3.connect(db_fn)
+    conn.execute("DROP TABLE IF EXISTS {0};".format(table_name))
+    conn.execute("CREATE TABLE {0} (uid integer, fips text, count integer, ntime integer);".format(table_name))
+    conn.executemany("INSERT INTO {0} VALUES (?, ?, ?, ?);".format(table_name), rows)
+    conn.commit()
+    conn.close()
@@ -0,0 +1,230 @@
+"""Build the n-day/plurality table (uid, fips, count, ntime) straight from the tweet CSV instead of PostgreSQL.
+
+For each (uid, county) pair the first and last tweet times and the number of tweets are kept in compact NumPy arrays.
+The output file has the same columns as the nday_* tables with ntime written in seconds; read_nday_table yields rows
+in the same shape that psycopg2 returns (ntime as a datetime.timedelta) so either source can feed localness.py and
+metrics/algorithm_recall.py.
+"""
+
+import argparse
+import csv
+import datetime
+
+import numpy
+
+from county_index import load_county_index
+from county_grid import load_county_grid
+from point_cache import PointCache
+from nday_db import write_sqlite
+from tweet_fields import TweetParser
+from tweet_fields import parse_created_at
+from tweet_columns import MISSING_TIME
+from tweet_columns import iter_chunks
+from tweet_fields import LOCALNESS_FIELDS
+
+INPUT_FN = "<FILE PATH TO INPUT VGI DATA CSV>"
+OUTPUT_FN = "<FILE PATH TO OUTPUT NDAY CSV>"
+OUTPUT_HEADER = ['uid', 'fips', 'count', 'ntime']
+CHUNK_SIZE = 100000  # tweets parsed and assigned to counties at a time
+
+
+class NdayAggregator(object):
+    """Streaming (uid, fips) -> (first time, last time, count) aggregation over compact arrays.
+
+    Tweets are buffered as int64 uid / int16 county index / int64 seconds arrays and folded into the sorted aggregate
+    once the buffer is as large as the aggregate, so each tweet is only sorted a logarithmic number of times.
+    """
+
+    def __init__(self, fips, chunk_size=CHUNK_SIZE):
+        self.fips = list(fips)
+        self.fips_idx = {self.fips[i]: i for i in range(0, len(self.fips))}
+        self.chunk_size = chunk_size
+        self.uids = numpy.empty(0, dtype=numpy.int64)
+        self.counties = numpy.empty(0, dtype=numpy.int16)
+        self.first = numpy.empty(0, dtype=numpy.int64)
+        self.last = numpy.empty(0, dtype=numpy.int64)
+        self.counts = numpy.empty(0, dtype=numpy.int64)
+        self.buffered = []
+        self.num_buffered = 0
+        self.count_tweets = 0
+
+    def __len__(self):
+        self.merge()
+        return len(self.uids)
+
+    def add(self, uids, counties, times):
+        """Add equal-length sequences of int uids, FIPS codes, and epoch seconds."""
+        counties = numpy.array([self.fips_idx[fips] for fips in counties], dtype=numpy.int16)
+        self.add_indexed(numpy.asarray(uids, dtype=numpy.int64), counties, numpy.asarray(times, dtype=numpy.int64))
+
+    def add_indexed(self, uids, counties, times):
+        """Add arrays where counties are already indices into fips."""
+        self.buffered.append((uids, counties, times))
+        self.num_buffered += len(uids)
+        self.count_tweets += len(uids)
+        if self.num_buffered >= max(self.chunk_size, len(self.uids)):
+            self.merge()
+
+    def merge(self):
+        """Fold the buffered tweets into the aggregate."""
+        if not self.buffered:
+            return
+        uids = numpy.concatenate([self.uids] + [b[0] for b in self.buffered])
+        counties = numpy.concatenate([self.counties] + [b[1] for b in self.buffered])
+        first = numpy.concatenate([self.first] + [b[2] for b in self.buffered])
+        last = numpy.concatenate([self.last] + [b[2] for b in self.buffered])
+        counts = numpy.concatenate([self.counts] + [numpy.ones(len(b[0]), dtype=numpy.int64) for b in self.buffered])
+        self.buffered = []
+        self.num_buffered = 0
+
+        order = numpy.lexsort((counties, uids))
+        uids = uids[order]
+        counties = counties[order]
+        starts = numpy.flatnonzero(numpy.r_[True, (uids[1:] != uids[:-1]) | (counties[1:] != counties[:-1])])
+        self.uids = uids[starts]
+        self.counties = counties[starts]
+        self.first = numpy.minimum.reduceat(first[order], starts)
+        self.last = numpy.maximum.reduceat(last[order], starts)
+        self.counts = numpy.add.reduceat(counts[order], starts)
+
+    def rows(self):
+        """Yield (uid, fips, count, ntime seconds) sorted by uid and then county."""
+        self.merge()
+        ntimes = self.last - self.first
+        for i in range(0, len(self.uids)):
+            yield int(self.uids[i]), self.fips[self.counties[i]], int(self.counts[i]), int(ntimes[i])
+
+    def write(self, output_fn):
+        with open(output_fn, 'w') as fout:
+            csvwriter = csv.writer(fout)
+            csvwriter.writerow(OUTPUT_HEADER)
+            csvwriter.writerows(self.rows())
+
+
+def read_nday_table(nday_fn):
+    """Yield (uid, fips, count, ntime) rows from a file written by NdayAggregator.write with ntime as a timedelta."""
+    with open(nday_fn, 'r') as fin:
+        csvreader = csv.reader(fin)
+        assert next(csvreader) == OUTPUT_HEADER
+        for line in csvreader:
+            yield int(line[0]), line[1], int(line[2]), datetime.timedelta(seconds=int(line[3]))
+
+
+def add_chunk(aggregator, county_index, uids, times, counties, lats, lons, fips_length):
+    """Add a chunk of geotagged tweets, looking up counties from lats/lons if counties weren't precomputed.
+
+    :return: number of tweets in the chunk located in a county
+    """
+    if not counties:
+        counties = county_index.lookup_many(lats, lons)
+    keep = [i for i in range(0, len(counties)) if counties[i]]
+    aggregator.add([uids[i] for i in keep], [counties[i][:fips_length] for i in keep], [times[i] for i in keep])
+    return len(keep)
+
+
+def build_nday_table(input_fn, county_index, tweet_idx=0, county_idx=-1, has_header=False, fips_length=5,
+                     chunk_size=CHUNK_SIZE, json_backend='auto'):
+    """Stream the tweet CSV once and return an NdayAggregator over its geotagged tweets.
+
+    :param county_idx: column with a precomputed FIPS code, or -1 to look up the county from the tweet coordinates
+    """
+    fips = sorted(set(f[:fips_length] for f in county_index.fips))
+    aggregator = NdayAggregator(fips, chunk_size)
+    parser = TweetParser(LOCALNESS_FIELDS, json_backend)
+    line_number = 0
+    count_failed = 0
+    count_located = 0
+    uids, times, counties, lats, lons = [], [], [], [], []
+    with open(input_fn, 'r') as fin:
+        csvreader = csv.reader(fin)
+        if has_header:
+            next(csvreader)
+        for record in csvreader:
+            line_number += 1
+            try:
+                tweet = parser.parse(record[tweet_idx])
+                if county_idx >= 0:
+                    if record[county_idx]:
+                        uid = int(tweet['user']['id'])
+                        created_at = parse_created_at(tweet['created_at'])
+                        counties.append(record[county_idx])
+                        uids.append(uid)
+                        times.append(created_at)
+                elif tweet['geo']:
+                    uid = int(tweet['user']['id'])
+                    created_at = parse_created_at(tweet['created_at'])
+                    lat, lon = float(tweet['geo']['coordinates'][0]), float(tweet['geo']['coordinates'][1])
+                    lats.append(lat)
+                    lons.append(lon)
+                    uids.append(uid)
+                    times.append(created_at)
+            except Exception as e:
+                count_failed += 1
+                print(e)
+                print(record)
+            if len(uids) == chunk_size:
+                count_located += add_chunk(aggregator, county_index, uids, times, counties, lats, lons, fips_length)
+                uids, times, counties, lats, lons = [], [], [], [], []
+            if line_number % 100000 == 0:
+                print("{0} lines read in, {1} located in a county, and {2} failed.".format(
+                    line_number, count_located, count_failed))
+    if uids:
+        count_located += add_chunk(aggregator, county_index, uids, times, counties, lats, lons, fips_length)
+    print("{0} lines read in, {1} located in a county, and {2} failed.".format(line_number, count_located, count_failed))
+    return aggregator
+
+
+def build_nday_table_from_columns(columns_dir, county_index, fips_length=5, chunk_size=CHUNK_SIZE):
+    """Same as build_nday_table from a utils/tweet_columns.py store, reading only the uid, lat/lon, and time columns."""
+    fips = sorted(set(f[:fips_length] for f in county_index.fips))
+    aggregator = NdayAggregator(fips, chunk_size)
+    count_rows = 0
+    count_failed = 0
+    count_located = 0
+    for chunk in iter_chunks(columns_dir, ['uid', 'lat', 'lon', 'created_at']):
+        count_rows += len(chunk['uid'])
+        geotagged = ~numpy.isnan(chunk['lat'])
+        dated = chunk['created_at'] != MISSING_TIME
+        count_failed += int(numpy.count_nonzero(geotagged & ~dated))
+        keep = geotagged & dated
+        count_located += add_chunk(aggregator, county_index, chunk['uid'][keep].tolist(),
+                                   chunk['created_at'][keep].tolist(), [], chunk['lat'][keep], chunk['lon'][keep],
+                                   fips_length)
+        print("{0} rows read in, {1} located in a county, and {2} failed.".format(
+            count_rows, count_located, count_failed))
+    return aggregator
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_fn', default=INPUT_FN, help="Tweet CSV (e.g., the INPUT_FN of localness.py)")
+    parser.add_argument('--columns_dir', default=None, help="utils/tweet_columns.py store to read instead of input_fn")
+    parser.add_argument('--output_fn', default=OUTPUT_FN)
+    parser.add_argument('--tweet_idx', type=int, default=0, help="Column with the tweet JSON")
+    parser.add_argument('--county_idx', type=int, default=-1,
+                        help="Column with a precomputed FIPS code (-1 = look up the county from the coordinates)")
+    parser.add_argument('--has_header', action='store_true')
+    parser.add_argument('--fips_length', type=int, default=5, help="5 for counties or 2 for states")
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--sqlite_fn', default=None, help="Also load the table into this SQLite database")
+    parser.add_argument('--table_name', default='nday', help="Table name with --sqlite_fn")
+    parser.add_argument('--json_backend', default='auto', choices=['auto', 'orjson', 'ujson', 'json'])
+    args = parser.parse_args()
+
+    county_index = PointCache(load_county_grid(load_county_index()))
+    if args.columns_dir:
+        aggregator = build_nday_table_from_columns(args.columns_dir, county_index, args.fips_length, args.chunk_size)
+    else:
+        aggregator = build_nday_table(args.input_fn, county_index, args.tweet_idx, args.county_idx, args.has_header,
+                                      args.fips_length, args.chunk_size, args.json_backend)
+    aggregator.write(args.output_fn)
+    print("{0} (uid, fips) rows from {1} tweets written to {2}.".format(len(aggregator), aggregator.count_tweets,
+                                                                       args.output_fn))
+    if args.sqlite_fn:
+        write_sqlite(args.sqlite_fn, args.table_name, aggregator.rows())
+        print("Table {0} written to {1}.".format(args.table_name, args.sqlite_fn))
+    county_index.print_stats()
+
+
+if __name__ == "__main__":
+    main()
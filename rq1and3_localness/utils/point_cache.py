@@ -0,0 +1,121 @@
+"""Bounded LRU cache of point -> county results keyed on quantized lat/lon, optionally persisted between runs."""
+
+import csv
+import json
+import os
+import zlib
+from collections import OrderedDict
+
+import numpy
+
+QUANTIZE_DECIMALS = 6  # ~0.1 m at the equator; geo_median already rounds to this so its results are cached exactly
+MAX_SIZE = 2000000
+MISSING = object()
+
+
+class PointCache(object):
+    """Wraps a county lookup (CountyIndex or CountyGrid) and exposes the same lookup methods.
+
+    Points are rounded to `decimals` places and the county is computed for the rounded point, so results do not depend
+    on which point in a quantization cell was seen first. Points outside all counties are cached too. A saved cache
+    records the decimals and county data it was built with and is only loaded by a cache with the same ones.
+    """
+
+    def __init__(self, county_index, decimals=QUANTIZE_DECIMALS, max_size=MAX_SIZE, cache_fn=None):
+        self.county_index = county_index
+        self.fips = county_index.fips
+        self.decimals = decimals
+        self.max_size = max_size
+        self.cache_fn = cache_fn
+        self.settings = {'decimals': decimals, 'counties': len(self.fips),
+                         'fips_crc': zlib.crc32(','.join(self.fips).encode('utf-8')),
+                         'source': getattr(county_index, 'source', None)}
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if cache_fn and os.path.exists(cache_fn):
+            self.load(cache_fn)
+
+    def __len__(self):
+        return len(self.fips)
+
+    def add(self, key, fips):
+        self.cache[key] = fips
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)  # evict least recently used
+
+    def lookup(self, lat, lon):
+        """Return the FIPS code of the county containing (lat, lon) or None if outside all counties."""
+        key = (round(lat, self.decimals), round(lon, self.decimals))
+        fips = self.cache.get(key, MISSING)
+        if fips is MISSING:
+            self.misses += 1
+            fips = self.county_index.lookup(key[0], key[1])
+            self.add(key, fips)
+        else:
+            self.hits += 1
+            self.cache.move_to_end(key)
+        return fips
+
+    def lookup_point(self, pt):
+        return self.lookup(pt.y, pt.x)
+
+    def lookup_many(self, lats, lons):
+        """Answer cached points directly and send the distinct misses to the wrapped batch lookup."""
+        lats = numpy.asarray(lats, dtype=numpy.float64).tolist()
+        lons = numpy.asarray(lons, dtype=numpy.float64).tolist()
+        results = [None] * len(lats)
+        missed = OrderedDict()  # key -> indices of points waiting on that key
+        for i in range(0, len(lats)):
+            if lats[i] != lats[i] or lons[i] != lons[i]:  # NaN
+                continue
+            key = (round(lats[i], self.decimals), round(lons[i], self.decimals))
+            fips = self.cache.get(key, MISSING)
+            if fips is MISSING:
+                self.misses += 1
+                missed.setdefault(key, []).append(i)
+            else:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                results[i] = fips
+        if missed:
+            keys = list(missed.keys())
+            missed_results = self.county_index.lookup_many([key[0] for key in keys], [key[1] for key in keys])
+            for j in range(0, len(keys)):
+                self.add(keys[j], missed_results[j])
+                for i in missed[keys[j]]:
+                    results[i] = missed_results[j]
+        return results
+
+    def load(self, cache_fn):
+        """Read a cache written by save(). Entries are in least to most recently used order."""
+        with open(cache_fn, 'r') as fin:
+            csvreader = csv.reader(fin)
+            line = next(csvreader, None)
+            if not line or line[0] != 'settings' or json.loads(line[1]) != self.settings:
+                print("Not loading {0}: it was saved with different decimals or county data than {1}.".format(
+                    cache_fn, self.settings))
+                return
+            assert next(csvreader) == ['lat', 'lon', 'fips']
+            for line in csvreader:
+                self.add((float(line[0]), float(line[1])), line[2] or None)
+        print("{0} cached points loaded from {1}.".format(len(self.cache), cache_fn))
+
+    def save(self, cache_fn=None):
+        cache_fn = cache_fn or self.cache_fn
+        if not cache_fn:
+            return
+        with open(cache_fn, 'w') as fout:
+            csvwriter = csv.writer(fout)
+            csvwriter.writerow(['settings', json.dumps(self.settings, sort_keys=True)])
+            csvwriter.writerow(['lat', 'lon', 'fips'])
+            for key, fips in self.cache.items():
+                csvwriter.writerow([repr(key[0]), repr(key[1]), fips])
+        print("{0} cached points saved to {1}.".format(len(self.cache), cache_fn))
+
+    def print_stats(self):
+        total = self.hits + self.misses
+        print("Point cache: {0} hits and {1} misses ({2:.1%} hit rate) with {3} entries at {4} decimals.".format(
+            self.hits, self.misses, float(self.hits) / total if total else 0, len(self.cache), self.decimals))
+        if hasattr(self.county_index, 'print_stats'):
+            self.county_index.print_stats()
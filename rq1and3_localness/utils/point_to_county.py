@@ -1,10 +1,34 @@
-import json
 import csv
 import argparse
 
-from shapely.wkt import loads
-from shapely.geometry import shape
-from shapely.geometry import box
+import numpy
+
+from county_index import load_county_index
+from county_grid import load_county_grid
+from point_cache import PointCache
+from point_cache import QUANTIZE_DECIMALS
+from point_cache import MAX_SIZE
+
+
+def parse_point(point):
+    """Parse a '(lat, lon)' string into floats, returning NaNs if it cannot be parsed."""
+    try:
+        latlon = point[1:-1].split(',')
+        return float(latlon[0]), float(latlon[1])
+    except (ValueError, IndexError):
+        return numpy.nan, numpy.nan
+
+
+def assign_chunk(county_index, lines, pt_index):
+    """Assign FIPS codes to a chunk of CSV rows in one vectorized lookup.
+
+    :return: list of counties (or None) in the same order as lines
+    """
+    lats = numpy.empty(len(lines), dtype=numpy.float64)
+    lons = numpy.empty(len(lines), dtype=numpy.float64)
+    for i in range(0, len(lines)):
+        lats[i], lons[i] = parse_point(lines[i][pt_index])
+    return county_index.lookup_many(lats, lons), int(numpy.count_nonzero(~numpy.isnan(lats)))
 
 
 def main(geo_median=True, locfield=False, vgi_repository='t51m'):
@@ -29,38 +53,36 @@ def main(geo_median=True, locfield=False, vgi_repository='t51m'):
     parser.add_argument('--output_header', default=OUTPUT_HEADER)
     parser.add_argument('--pt_index', default=PT_INDEX)
     parser.add_argument('--vgi_repository', default=vgi_repository)
+    parser.add_argument('--batch_size', type=int, default=0,
+                        help="Assign counties to this many rows at a time with vectorized lookups (0 = row by row)")
+    parser.add_argument('--county_grid', action='store_true',
+                        help="Use the precomputed county grid so only points near boundaries get an exact polygon test")
+    parser.add_argument('--cache_decimals', type=int, default=QUANTIZE_DECIMALS,
+                        help="Decimal places lat/lon are rounded to for the point -> county cache")
+    parser.add_argument('--cache_size', type=int, default=MAX_SIZE)
+    parser.add_argument('--cache_fn', default=None, help="CSV file to load the point cache from and save it to")
     args = parser.parse_args()
     POINTS_FN = args.points_fn
     OUTPUT_FN = args.output_fn
     EXPECTED_HEADER = args.expected_header
     OUTPUT_HEADER = args.output_header
-    PT_INDEX = args.pt_index
+    PT_INDEX = int(args.pt_index)
 
-    counties_fn = 'resources/USCounties_bare.geojson'
-    with open(counties_fn, 'r') as fin:
-        counties_gj = json.load(fin)
+    county_index = load_county_index()
+    if args.county_grid:
+        county_index = load_county_grid(county_index)
+    point_cache = PointCache(county_index, args.cache_decimals, args.cache_size, args.cache_fn)
 
-    states_fn = 'resources/US_States_from_counties.geojson'
-    with open(states_fn, 'r') as fin:
-        states_gj = json.load(fin)
-
-    counties = {}
-    for state in states_gj['features']:
-        west, south, east, north = shape(state['geometry']).bounds
-        counties[state['properties']['FIPS'][:2]] = {'bb':box(west, south, east, north), 'counties':{}}
-    for region in counties_gj['features']:
-        state_fips = region['properties']['FIPS'][:2]
-        counties[state_fips]['counties'][region['properties']['FIPS']] = shape(region['geometry'])
-    del(counties_gj)
-    del(states_gj)
-
-    fast_lookup = {}
+    if args.batch_size > 0:
+        batch_main(point_cache, POINTS_FN, OUTPUT_FN, EXPECTED_HEADER, OUTPUT_HEADER, PT_INDEX, args.batch_size, geo_median)
+        point_cache.print_stats()
+        point_cache.save()
+        return
 
     eastUS = -66.885444
     westUS = -124.848974
     northUS = 49.384358
     southUS = 24.396308
-    boundingboxUS = box(westUS, southUS, eastUS, northUS)
 
     with open(POINTS_FN, 'r') as fin:
         csvreader = csv.reader(fin)
@@ -78,21 +100,13 @@ def main(geo_median=True, locfield=False, vgi_repository='t51m'):
                 county = None
                 try:
                     latlon = point[1:-1].split(',')
-                    pt = loads('POINT ({0} {1})'.format(latlon[1].strip(), latlon[0].strip()))
+                    lat = float(latlon[0])
+                    lon = float(latlon[1])
                     total_points += 1
-                    if line[PT_INDEX] in fast_lookup:
-                        county = fast_lookup[line[PT_INDEX]]
-                        points_in_US += 1
-                    else:
-                        if boundingboxUS.contains(pt):
-                            for state in counties:
-                                if counties[state]['bb'].contains(pt):
-                                    for fips in counties[state]['counties']:
-                                        if counties[state]['counties'][fips].contains(pt):
-                                            county = fips
-                                            points_in_US += 1
-                                            fast_lookup[line[PT_INDEX]] = county
-                                            break
+                    if westUS < lon < eastUS and southUS < lat < northUS:
+                        county = point_cache.lookup(lat, lon)
+                        if county:
+                            points_in_US += 1
                 except Exception as e:
                     if line[PT_INDEX]:
                         print(e)
@@ -104,6 +118,47 @@ def main(geo_median=True, locfield=False, vgi_repository='t51m'):
                 if total_points % 10000 == 0:
                     print ("{0} of {1} points in US and {2} lines in.".format(points_in_US, total_points, count_lines))
     print("{0} of {1} in the US out of {2} total lines.".format(points_in_US, total_points, count_lines))
+    point_cache.print_stats()
+    point_cache.save()
+
+
+def batch_main(county_index, points_fn, output_fn, expected_header, output_header, pt_index, batch_size, geo_median):
+    """Read points_fn in chunks of batch_size rows and write counties back out in input order."""
+    with open(points_fn, 'r') as fin:
+        csvreader = csv.reader(fin)
+        total_points = 0
+        points_in_US = 0
+        count_lines = 0
+        assert next(csvreader) == expected_header
+        with open(output_fn, 'w') as fout:
+            csvwriter = csv.writer(fout)
+            csvwriter.writerow(output_header)
+            chunk = []
+            for line in csvreader:
+                chunk.append(line)
+                if len(chunk) == batch_size:
+                    counties, num_points = assign_chunk(county_index, chunk, pt_index)
+                    write_chunk(csvwriter, chunk, counties, geo_median)
+                    count_lines += len(chunk)
+                    total_points += num_points
+                    points_in_US += sum(1 for county in counties if county)
+                    print("{0} of {1} points in US and {2} lines in.".format(points_in_US, total_points, count_lines))
+                    chunk = []
+            if chunk:
+                counties, num_points = assign_chunk(county_index, chunk, pt_index)
+                write_chunk(csvwriter, chunk, counties, geo_median)
+                count_lines += len(chunk)
+                total_points += num_points
+                points_in_US += sum(1 for county in counties if county)
+    print("{0} of {1} in the US out of {2} total lines.".format(points_in_US, total_points, count_lines))
+
+
+def write_chunk(csvwriter, lines, counties, geo_median):
+    if geo_median:
+        csvwriter.writerows([lines[i][0], counties[i]] for i in range(0, len(lines)))
+    else:
+        csvwriter.writerows([lines[i][0], lines[i][1], counties[i]] for i in range(0, len(lines)))
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,114 @@
+"""Per-stage timing and JSON-lines progress records for long loops like the one in localness.py."""
+
+import datetime
+import json
+import os
+import sys
+import time
+from time import perf_counter
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+
+class StageTimer(object):
+    """Accumulate call counts and wall time per stage into a {stage: [calls, seconds]} dict.
+
+    The dict can live in a run's counts so it is checkpointed and merged across chunks along with them. Usage:
+        t = time.perf_counter()
+        ...parse...
+        t = timer.time('json_parse', t)
+        ...look up county...
+        t = timer.time('county_lookup', t)
+    """
+
+    def __init__(self, stages=None):
+        self.stages = {} if stages is None else stages
+
+    def time(self, stage, start):
+        """Charge the time since start (a time.perf_counter() value) to stage and return the current time."""
+        now = perf_counter()
+        try:
+            entry = self.stages[stage]
+        except KeyError:
+            entry = self.stages[stage] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += now - start
+        return now
+
+    def merge(self, stages):
+        for stage, (calls, seconds) in stages.items():
+            entry = self.stages.setdefault(stage, [0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+
+    def report(self):
+        """{stage: {calls, sec, us_per_call, share}} with share the fraction of all timed seconds."""
+        total = sum(seconds for calls, seconds in self.stages.values()) or 1.0
+        return {stage: {'calls': calls, 'sec': round(seconds, 3),
+                        'us_per_call': round(1e6 * seconds / calls, 2) if calls else 0.0,
+                        'share': round(seconds / total, 4)}
+                for stage, (calls, seconds) in sorted(self.stages.items(), key=lambda x: -x[1][1])}
+
+    def summary(self):
+        return ', '.join('{0} {1:.1f}s ({2:.0%})'.format(stage, r['sec'], r['share'])
+                         for stage, r in self.report().items())
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process or its largest child in MB.
+
+    Children only count once they have exited and been waited for, so live pool workers are left out; they report
+    their own peak under 'peak_rss_mb' in the counts they return instead (see ProgressLog.record).
+    """
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(peak / (1048576.0 if sys.platform == 'darwin' else 1024.0), 1)  # bytes on macOS, KB on Linux
+
+
+class ProgressLog(object):
+    """Append one JSON record per write() to log_fn with throughput, ETA, peak RSS, and the stage timings.
+
+    fraction is a callable giving the share of the input read so far (for the ETA) or None. Rates and the ETA are
+    for this process since the log was created, so a resumed run doesn't count work done before it restarted. The
+    peak RSS is the larger of this process's and the 'peak_rss_mb' of the counts (the workers merged into them).
+    """
+
+    def __init__(self, log_fn, source, fraction=None, line_number=0):
+        self.log_fn = log_fn
+        self.source = source
+        self.fraction = fraction
+        self.start = time.time()
+        self.start_line = line_number
+        self.start_fraction = fraction() if fraction else 0.0
+
+    def record(self, counts, final=False):
+        elapsed = time.time() - self.start
+        lines = counts['line_number'] - self.start_line
+        done = self.fraction() if self.fraction else None
+        peak = peak_rss_mb()
+        if counts.get('peak_rss_mb') is not None:
+            peak = max(peak or 0.0, counts['peak_rss_mb'])
+        eta = None
+        if final:
+            eta = 0.0
+        elif done is not None and done > self.start_fraction:
+            eta = elapsed * (1.0 - done) / (done - self.start_fraction)
+        return {'time': datetime.datetime.now().isoformat(timespec='seconds'), 'source': self.source,
+                'pid': os.getpid(), 'line_number': counts['line_number'], 'processed': counts['processed'],
+                'failed': counts['failed'], 'elapsed_sec': round(elapsed, 1),
+                'rows_per_sec': round(lines / elapsed, 1) if elapsed > 0 else None,
+                'fraction_done': round(done, 4) if done is not None else None,
+                'eta_sec': round(eta, 1) if eta is not None else None, 'peak_rss_mb': peak,
+                'stages': StageTimer(counts['stages']).report(), 'final': final}
+
+    def write(self, counts, final=False):
+        if not self.log_fn:
+            return
+        line = json.dumps(self.record(counts, final)) + '\n'
+        with open(self.log_fn, 'a') as fout:  # one small append per record, so workers can share the file
+            fout.write(line)
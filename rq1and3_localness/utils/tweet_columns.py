@@ -0,0 +1,217 @@
+"""One-time extraction of the tweet fields the pipeline uses into a columnar, compressed, chunked store.
+
+A store is a folder of compressed NumPy archives, one per chunk of CHUNK_SIZE tweets: tweets_00000.npz, ... hold the
+extracted fields and localness.py writes its results for the same rows to localness_00000.npz, .... Each column is
+a separate member of the archive, so a stage only decompresses the columns it asks for.
+
+Columns (in tweets_*.npz):
+    row: int64 record number in the source CSV (0 = first record after any header)
+    uid: int64
+    lat, lon: float64 (NaN if the tweet isn't geotagged)
+    created_at: int64 seconds since the epoch (MISSING_TIME if absent or unreadable)
+    location, name, text: strings (None if absent or null)
+    has_location: bool, False if the user object has no location key (a failed location field lookup in localness.py)
+Strings are stored as one UTF-8 byte array per column with int64 offsets and a null mask.
+"""
+
+import argparse
+import csv
+import glob
+import os
+import re
+
+import numpy
+
+from tweet_fields import TweetParser
+from tweet_fields import parse_created_at
+
+CHUNK_SIZE = 500000  # tweets per chunk file
+TABLES = ['tweets', 'localness']  # chunk file prefixes, searched in this order for a column
+TWEET_COLUMNS = ['row', 'uid', 'lat', 'lon', 'created_at', 'location', 'has_location', 'name', 'text']
+COLUMN_FIELDS = [('user', 'id'), ('user', 'location'), ('user', 'name'), ('geo',), ('created_at',), ('text',)]
+MISSING_TIME = numpy.iinfo(numpy.int64).min
+
+
+def chunk_fn(columns_dir, table, chunk_idx):
+    return os.path.join(columns_dir, '{0}_{1:05d}.npz'.format(table, chunk_idx))
+
+
+def list_chunks(columns_dir, table='tweets'):
+    """Sorted chunk indices of a table in the store."""
+    pattern = re.compile(r'{0}_(\d+)\.npz$'.format(table))
+    chunks = []
+    for fn in glob.glob(os.path.join(columns_dir, '{0}_*.npz'.format(table))):
+        match = pattern.search(fn)
+        if match:
+            chunks.append(int(match.group(1)))
+    return sorted(chunks)
+
+
+def encode_strings(values):
+    """Return (UTF-8 bytes, offsets, null mask) arrays for a list of strings and Nones."""
+    encoded = [(v or '').encode('utf-8', 'surrogatepass') for v in values]
+    offsets = numpy.zeros(len(values) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(e) for e in encoded], out=offsets[1:])
+    data = numpy.frombuffer(b''.join(encoded), dtype=numpy.uint8)
+    null = numpy.array([v is None for v in values], dtype=bool)
+    return data, offsets, null
+
+
+def decode_strings(data, offsets, null):
+    raw = data.tobytes()
+    offsets = offsets.tolist()
+    null = null.tolist()
+    return [None if null[i] else raw[offsets[i]:offsets[i + 1]].decode('utf-8', 'surrogatepass')
+            for i in range(0, len(null))]
+
+
+def write_chunk(fn, columns):
+    """Write a dict of column -> NumPy array (stored as is) or list of strings/None to a compressed archive."""
+    members = {}
+    for name, values in columns.items():
+        if isinstance(values, numpy.ndarray):
+            members[name] = values
+        else:
+            members[name + '.data'], members[name + '.offsets'], members[name + '.null'] = encode_strings(values)
+    numpy.savez_compressed(fn, **members)
+
+
+def read_chunk(columns_dir, chunk_idx, columns):
+    """Return a dict of the requested columns for one chunk, taken from whichever table has them.
+
+    Numeric columns come back as NumPy arrays and string columns as lists of str/None.
+    """
+    result = {}
+    for table in TABLES:
+        fn = chunk_fn(columns_dir, table, chunk_idx)
+        if not os.path.exists(fn) or all(c in result for c in columns):
+            continue
+        with numpy.load(fn) as archive:  # members are only decompressed when accessed
+            for name in columns:
+                if name in result:
+                    continue
+                if name in archive.files:
+                    result[name] = archive[name]
+                elif name + '.offsets' in archive.files:
+                    result[name] = decode_strings(archive[name + '.data'], archive[name + '.offsets'],
+                                                  archive[name + '.null'])
+    missing = [c for c in columns if c not in result]
+    if missing:
+        raise KeyError("Columns {0} not in chunk {1} of {2}".format(missing, chunk_idx, columns_dir))
+    return result
+
+
+def iter_chunks(columns_dir, columns):
+    """Yield the requested columns chunk by chunk, in row order."""
+    for chunk_idx in list_chunks(columns_dir):
+        yield read_chunk(columns_dir, chunk_idx, columns)
+
+
+def iter_rows(columns_dir, columns):
+    """Yield one tuple per row with the requested columns (NumPy scalars converted to Python values)."""
+    for chunk in iter_chunks(columns_dir, columns):
+        values = [chunk[c].tolist() if isinstance(chunk[c], numpy.ndarray) else chunk[c] for c in columns]
+        for row in zip(*values):
+            yield row
+
+
+class ChunkBuilder(object):
+    """Accumulate extracted tweets and write them out CHUNK_SIZE at a time."""
+
+    def __init__(self, columns_dir, chunk_size=CHUNK_SIZE):
+        self.columns_dir = columns_dir
+        self.chunk_size = chunk_size
+        self.num_chunks = 0
+        self.num_rows = 0
+        self.reset()
+
+    def reset(self):
+        self.columns = {name: [] for name in TWEET_COLUMNS}
+
+    def add(self, row, uid, lat, lon, created_at, location, has_location, name, text):
+        for column, value in zip(TWEET_COLUMNS, [row, uid, lat, lon, created_at, location, has_location, name, text]):
+            self.columns[column].append(value)
+        if len(self.columns['row']) == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.columns['row']:
+            return
+        columns = self.columns
+        for name, dtype in [('row', numpy.int64), ('uid', numpy.int64), ('lat', numpy.float64),
+                            ('lon', numpy.float64), ('created_at', numpy.int64), ('has_location', bool)]:
+            columns[name] = numpy.array(columns[name], dtype=dtype)
+        write_chunk(chunk_fn(self.columns_dir, 'tweets', self.num_chunks), columns)
+        self.num_chunks += 1
+        self.num_rows += len(columns['row'])
+        self.reset()
+
+
+def extract_tweet(tweet):
+    """Return (uid, lat, lon, created_at, location, has_location, name, text) from a parsed tweet.
+
+    Raises if it has no user id.
+    """
+    uid = int(tweet['user']['id'])
+    lat, lon = numpy.nan, numpy.nan
+    if tweet.get('geo'):
+        lat, lon = float(tweet['geo']['coordinates'][0]), float(tweet['geo']['coordinates'][1])
+    created_at = MISSING_TIME
+    if tweet.get('created_at'):
+        try:
+            created_at = parse_created_at(tweet['created_at'])
+        except (ValueError, KeyError, IndexError):
+            pass
+    return (uid, lat, lon, created_at, tweet['user'].get('location'), 'location' in tweet['user'],
+            tweet['user'].get('name'), tweet.get('text'))
+
+
+def extract_columns(input_fn, columns_dir, tweet_idx=0, has_header=False, chunk_size=CHUNK_SIZE,
+                    json_backend='auto'):
+    """Parse each tweet in the CSV once and write the store. Tweets without a readable user id are skipped."""
+    if not os.path.isdir(columns_dir):
+        os.makedirs(columns_dir)
+    for table in TABLES:
+        for chunk_idx in list_chunks(columns_dir, table):
+            os.remove(chunk_fn(columns_dir, table, chunk_idx))
+    parser = TweetParser(COLUMN_FIELDS, json_backend)
+    builder = ChunkBuilder(columns_dir, chunk_size)
+    count_failed = 0
+    row = -1
+    with open(input_fn, 'r') as fin:
+        csvreader = csv.reader(fin)
+        if has_header:
+            next(csvreader)
+        for record in csvreader:
+            row += 1
+            try:
+                builder.add(row, *extract_tweet(parser.parse(record[tweet_idx])))
+            except Exception as e:
+                count_failed += 1
+                print(e)
+                print(record)
+            if (row + 1) % 100000 == 0:
+                print("{0} lines read in and {1} failed.".format(row + 1, count_failed))
+    builder.flush()
+    print("{0} tweets in {1} chunks written to {2} ({3} lines failed).".format(
+        builder.num_rows, builder.num_chunks, columns_dir, count_failed))
+    return builder.num_rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_fn', help="Tweet CSV (e.g., the INPUT_FN of localness.py)")
+    parser.add_argument('columns_dir', help="Folder for the columnar store")
+    parser.add_argument('--tweet_idx', type=int, default=0, help="Column with the tweet JSON")
+    parser.add_argument('--has_header', action='store_true')
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--json_backend', default='auto', choices=['auto', 'orjson', 'ujson', 'json'])
+    args = parser.parse_args()
+    extract_columns(args.input_fn, args.columns_dir, args.tweet_idx, args.has_header, args.chunk_size,
+                    args.json_backend)
+    store_bytes = sum(os.path.getsize(chunk_fn(args.columns_dir, 'tweets', i)) for i in list_chunks(args.columns_dir))
+    print("{0:.1f} MB store from a {1:.1f} MB CSV.".format(store_bytes / 1e6, os.path.getsize(args.input_fn) / 1e6))
+
+
+if __name__ == "__main__":
+    main()
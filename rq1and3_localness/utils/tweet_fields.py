@@ -0,0 +1,132 @@
+"""Pull just the fields the pipeline uses out of raw tweet JSON, with a faster JSON backend when one is installed."""
+
+import argparse
+import calendar
+import csv
+import datetime
+import json
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+BACKEND = 'auto'  # 'orjson', 'ujson', 'json', or 'auto' for the fastest one installed
+# every path a localness stage reads from a tweet
+LOCALNESS_FIELDS = [('user', 'id'), ('user', 'location'), ('user', 'name'), ('geo',), ('created_at',)]
+TEXT_FIELDS = [('user', 'id'), ('text',)]
+MONTHS = {month: i for i, month in enumerate(calendar.month_abbr) if month}
+
+
+def get_loads(backend=BACKEND):
+    """Return (name, loads function) for the requested JSON backend."""
+    if backend in ('auto', 'orjson') and orjson is not None:
+        return 'orjson', orjson.loads
+    if backend in ('auto', 'ujson') and ujson is not None:
+        return 'ujson', ujson.loads
+    if backend not in ('auto', 'json'):
+        print("JSON backend {0} isn't installed - using json.".format(backend))
+    return 'json', json.loads
+
+
+def parse_created_at(created_at):
+    """Return seconds since the epoch for a Twitter created_at string (e.g., 'Wed Aug 27 13:08:45 +0000 2008').
+
+    Falls back on ISO 8601 (e.g., '2008-08-27 13:08:45' as exported from PostgreSQL) assumed to be UTC.
+    """
+    parts = created_at.split()
+    if len(parts) == 6 and parts[4] == '+0000':
+        hour, minute, second = parts[3].split(':')
+        return calendar.timegm((int(parts[5]), MONTHS[parts[1]], int(parts[2]), int(hour), int(minute), int(second)))
+    dt = datetime.datetime.fromisoformat(created_at)
+    if dt.tzinfo is not None:
+        return int(dt.timestamp())
+    return calendar.timegm(dt.timetuple())
+
+
+class TweetParser(object):
+    """Parse raw tweet JSON and keep only the given paths as a nested dict shaped like the tweet.
+
+    Downstream code can index the result as it did the full tweet (e.g., tweet['user']['location']). Paths missing
+    from the tweet are left out, so they raise KeyError where they did before. JSON the fast backend rejects (e.g.,
+    lone surrogate escapes that Twitter sometimes emits) is re-parsed with the stdlib so results never depend on the
+    backend.
+    """
+
+    def __init__(self, fields=LOCALNESS_FIELDS, backend=BACKEND):
+        self.fields = fields
+        self.backend, self.fast_loads = get_loads(backend)
+        self.count_fallback = 0
+
+    def loads(self, raw):
+        try:
+            return self.fast_loads(raw)
+        except ValueError:
+            if self.fast_loads is json.loads:
+                raise
+            self.count_fallback += 1
+            return json.loads(raw)
+
+    def parse(self, raw):
+        tweet = self.loads(raw)
+        fields = {}
+        for path in self.fields:
+            value = tweet
+            for key in path:
+                if not isinstance(value, dict) or key not in value:
+                    break
+                value = value[key]
+            else:
+                parent = fields
+                for key in path[:-1]:
+                    parent = parent.setdefault(key, {})
+                parent[path[-1]] = value
+        return fields
+
+
+def benchmark(input_fn, tweet_idx=0, has_header=False, max_lines=100000):
+    """Compare tweets/sec for json.loads on the full tweet and TweetParser with each installed backend."""
+    raws = []
+    with open(input_fn, 'r') as fin:
+        csvreader = csv.reader(fin)
+        if has_header:
+            next(csvreader)
+        for record in csvreader:
+            raws.append(record[tweet_idx])
+            if len(raws) == max_lines:
+                break
+
+    def rate(parse):
+        failed = 0
+        start = time.time()
+        for raw in raws:
+            try:
+                parse(raw)
+            except Exception:
+                failed += 1
+        return len(raws) / (time.time() - start), failed
+
+    base_rate, failed = rate(json.loads)
+    print("json.loads full tweet: {0:.0f} tweets/sec ({1} failed).".format(base_rate, failed))
+    for backend, module in [('json', json), ('ujson', ujson), ('orjson', orjson)]:
+        if module is None:
+            continue
+        parser = TweetParser(LOCALNESS_FIELDS, backend)
+        parser_rate, failed = rate(parser.parse)
+        print("TweetParser ({0}): {1:.0f} tweets/sec ({2:.1f}x, {3} failed, {4} stdlib fallbacks).".format(
+            backend, parser_rate, parser_rate / base_rate, failed, parser.count_fallback))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_fn', help="CSV with a tweet JSON column (e.g., the INPUT_FN of localness.py)")
+    parser.add_argument('--tweet_idx', type=int, default=0)
+    parser.add_argument('--has_header', action='store_true')
+    parser.add_argument('--max_lines', type=int, default=100000)
+    args = parser.parse_args()
+    benchmark(args.input_fn, args.tweet_idx, args.has_header, args.max_lines)
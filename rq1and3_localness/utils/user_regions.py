@@ -0,0 +1,154 @@
+"""Compact per-user county store for the n-day, plurality, and geometric median lookups in localness.py.
+
+Users are a sorted int64 array with offsets into per-user runs of int16 county indices and a flags byte, so a user
+costs ~20 bytes plus ~3 bytes per county instead of a dict of strings.
+"""
+
+import array
+
+import numpy
+
+LOCAL = 1  # county is local under n-days
+PLURALITY = 2  # county has the user's most VGI (ties included)
+MEDIAN_UNSET = -2  # no geometric median result for the user
+NO_MEDIAN = -1  # geometric median failed or fell outside the user's counties
+
+
+class UserRegions(object):
+    """Build from nday rows (add_rows) or SQL summaries (add_summaries), then finalize() before lookups."""
+
+    def __init__(self, nday_min, fips_length=5):
+        self.nday_min = nday_min
+        self.fips_length = fips_length
+        self.fips = []
+        self.fips_idx = {}
+        # build buffers: one entry per nday row
+        self.row_uids = array.array('q')
+        self.row_regions = array.array('h')
+        self.row_counts = array.array('q')
+        self.row_days = array.array('q')
+        self.users = None
+        self.offsets = None
+        self.regions = None
+        self.flags = None
+        self.medians = None
+
+    def region_index(self, region):
+        """Index of a FIPS code in the county table (-1 for NULL), adding it if new."""
+        if not region:
+            return -1
+        region = region[:self.fips_length]
+        if region not in self.fips_idx:
+            self.fips_idx[region] = len(self.fips)
+            self.fips.append(region)
+        return self.fips_idx[region]
+
+    def add_rows(self, rows):
+        """Add (uid, fips, count, ntime) rows as they come from the nday table (ntime a timedelta)."""
+        for uid, region, count, ntime in rows:
+            self.row_uids.append(int(uid))
+            self.row_regions.append(self.region_index(region))
+            self.row_counts.append(count)
+            self.row_days.append(ntime.days)
+
+    def add_summaries(self, summaries):
+        """Add (uid, plurality_count, counties, plurality counties, local counties) from nday_db.stream_user_summaries.
+
+        Each county becomes a row with count 1 if it is a plurality county (else 0) and days at or above nday_min if
+        it is local, which finalize() turns back into the same flags. A user whose counties are all NULL gets one NULL
+        row so they are still a user, as they are with add_rows.
+        """
+        for uid, plurality_count, regions, plurality, local in summaries:
+            if not regions:
+                self.row_uids.append(int(uid))
+                self.row_regions.append(-1)
+                self.row_counts.append(0)
+                self.row_days.append(-1)
+                continue
+            plurality = set(plurality)
+            local = set(local)
+            for region in regions:
+                self.row_uids.append(int(uid))
+                self.row_regions.append(self.region_index(region))
+                self.row_counts.append(1 if region in plurality else 0)
+                self.row_days.append(self.nday_min if region in local else -1)
+
+    def finalize(self):
+        """Sort the rows by user and county and compute the n-day and plurality flags."""
+        uids = numpy.frombuffer(self.row_uids, dtype=numpy.int64)
+        regions = numpy.frombuffer(self.row_regions, dtype=numpy.int16)
+        counts = numpy.frombuffer(self.row_counts, dtype=numpy.int64)
+        days = numpy.frombuffer(self.row_days, dtype=numpy.int64)
+        order = numpy.lexsort((regions, uids))  # stable, so repeated (uid, county) rows stay in input order
+        uids = uids[order]
+        regions = regions[order]
+        counts = counts[order]
+        days = days[order]
+
+        user_starts = numpy.flatnonzero(numpy.r_[True, uids[1:] != uids[:-1]]) if len(uids) else numpy.empty(0, int)
+        max_counts = numpy.repeat(numpy.maximum.reduceat(counts, user_starts) if len(uids) else counts,
+                                  numpy.diff(numpy.r_[user_starts, len(uids)]))
+        plurality = (counts == max_counts) & (counts > 0)  # NULL counties count toward the max but aren't kept
+
+        # counties repeated after truncating FIPS codes: last row sets n-day (as the dict did), any row sets plurality
+        starts = numpy.flatnonzero(numpy.r_[True, (uids[1:] != uids[:-1]) | (regions[1:] != regions[:-1])]) \
+            if len(uids) else numpy.empty(0, int)
+        ends = numpy.r_[starts[1:], len(uids)] - 1
+        flags = numpy.where(days[ends] >= self.nday_min, LOCAL, 0).astype(numpy.uint8)
+        if len(uids):
+            flags |= numpy.where(numpy.logical_or.reduceat(plurality, starts), PLURALITY, 0).astype(numpy.uint8)
+        keep = regions[starts] >= 0
+
+        self.users = uids[user_starts]
+        self.regions = regions[starts][keep]
+        self.flags = flags[keep]
+        kept_uids = uids[starts][keep]
+        self.offsets = numpy.searchsorted(kept_uids, numpy.r_[self.users, numpy.iinfo(numpy.int64).max])
+        self.medians = numpy.full(len(self.users), MEDIAN_UNSET, dtype=numpy.int16)
+        self.row_uids = self.row_regions = self.row_counts = self.row_days = None
+
+    def __len__(self):
+        return len(self.users)
+
+    def __contains__(self, uid):
+        try:
+            self.user_index(uid)
+        except KeyError:
+            return False
+        return True
+
+    def user_index(self, uid):
+        """Position of uid (string or int) in users, raising KeyError if the user has no nday rows."""
+        try:
+            uid = int(uid)
+        except ValueError:
+            raise KeyError(uid)
+        u = int(numpy.searchsorted(self.users, uid))
+        if u == len(self.users) or self.users[u] != uid:
+            raise KeyError(uid)
+        return u
+
+    def set_median(self, uid, region):
+        """Record the user's geometric median county (None/empty if the median failed)."""
+        u = self.user_index(uid)
+        self.medians[u] = self.fips_idx.get(region[:self.fips_length], NO_MEDIAN) if region else NO_MEDIAN
+
+    def lookup(self, uid, region):
+        """Return (n-day, plurality, geometric median) for a tweet by uid in county region.
+
+        Raises KeyError, as the dicts did, if the user has no nday row for the county or no geometric median result.
+        """
+        u = self.user_index(uid)
+        r = self.fips_idx[region]
+        lo = self.offsets[u]
+        hi = self.offsets[u + 1]
+        i = lo + int(numpy.searchsorted(self.regions[lo:hi], r))
+        if i == hi or self.regions[i] != r:
+            raise KeyError(region)
+        median = self.medians[u]
+        if median == MEDIAN_UNSET:
+            raise KeyError('median')
+        return bool(self.flags[i] & LOCAL), bool(self.flags[i] & PLURALITY), median == r
+
+    def nbytes(self):
+        return self.users.nbytes + self.offsets.nbytes + self.regions.nbytes + self.flags.nbytes + self.medians.nbytes